@@ -0,0 +1,97 @@
+# Synthetic xjst-like template bundles and BEMJSON trees of configurable size
+
+import random
+
+
+TEMPLATE = u"""
+function block%(n)d(ctx, buf) {
+    var mods = ctx.mods || {};
+    if (ctx.block === "b-%(n)d" && !ctx.elem) {
+        buf.push("<div class=\\"b-%(n)d");
+        if (mods.theme) {
+            buf.push(" b-%(n)d_theme_" + mods.theme);
+        }
+        buf.push("\\">");
+        switch (ctx.tag) {
+            case "span":
+                buf.push("<span>");
+                break;
+            case "a":
+                buf.push("<a href=\\"" + ctx.url + "\\">");
+                break;
+            default:
+                buf.push("<i>");
+        }
+        if (ctx.content) {
+            apply(ctx.content, buf);
+        }
+        buf.push("</div>");
+        return true;
+    }
+    return false;
+}
+"""
+
+FOOTER = u"""
+var templates = {%(templates)s};
+
+function apply(ctx, buf) {
+    if (typeof ctx === "string") {
+        buf.push(ctx);
+        return;
+    }
+    if (typeof ctx.length === "number") {
+        var i = 0;
+        while (i < ctx.length) {
+            apply(ctx[i], buf);
+            i++;
+        }
+        return;
+    }
+    var template = templates[ctx.block];
+    if (!template || !template(ctx, buf)) {
+        buf.push("<div>");
+        if (ctx.content) {
+            apply(ctx.content, buf);
+        }
+        buf.push("</div>");
+    }
+}
+
+function render(ctx) {
+    var buf = [];
+    apply(ctx, buf);
+    return buf.join("");
+}
+"""
+
+
+def bundle(count):
+    templates = u", ".join(u'"b-%d": block%d' % (n, n) for n in xrange(count))
+
+    return u"".join(TEMPLATE % {'n': n} for n in xrange(count)) + FOOTER % {'templates': templates}
+
+
+def tree(blocks, depth, breadth, seed=0):
+    # Deterministic BEMJSON tree referring to blocks of a bundle of the given size
+    generator = random.Random(seed)
+
+    def node(level):
+        ctx = {u'block': u'b-%d' % generator.randrange(blocks)}
+
+        if generator.random() < 0.3:
+            ctx[u'mods'] = {u'theme': u'normal'}
+
+        ctx[u'tag'] = generator.choice([u'span', u'a', u'div'])
+
+        if ctx[u'tag'] == u'a':
+            ctx[u'url'] = u'/page/%d' % generator.randrange(1000)
+
+        if level < depth:
+            ctx[u'content'] = [node(level + 1) for i in xrange(breadth)]
+        else:
+            ctx[u'content'] = u'text %d' % generator.randrange(1000)
+
+        return ctx
+
+    return node(0)
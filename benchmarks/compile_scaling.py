@@ -0,0 +1,50 @@
+# Checks that compile time grows linearly with the size of the bundle
+#
+#   python benchmarks/compile_scaling.py [--repeat N] [sizes...]
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pybemhtml.compiler import Compiler
+
+from bundles import bundle
+
+
+def measure(source, repeat):
+    best = None
+
+    for i in xrange(repeat):
+        start = time.time()
+        Compiler().compile(source)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [sizes...]')
+    parser.add_option('--repeat', type='int', default=3)
+
+    options, args = parser.parse_args()
+
+    sizes = [int(arg) for arg in args] or [50, 100, 200, 400, 800]
+
+    print '%10s %10s %10s %12s' % ('templates', 'kbytes', 'seconds', 'us/kbyte')
+
+    for size in sizes:
+        source = bundle(size)
+        kbytes = len(source) / 1024.0
+        elapsed = measure(source, options.repeat)
+
+        print '%10d %10.1f %10.3f %12.1f' % (size, kbytes, elapsed, elapsed / kbytes * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Measures how long a fresh interpreter takes to import the runtime, which is
+# all a render worker loading precompiled templates needs, and the compiler
+#
+#   python benchmarks/import_time.py [--repeat N] [--budget MS]
+#
+# The script fails when the runtime takes longer than MS milliseconds over a
+# bare interpreter, 250 by default as in tests/test_runtime.py.
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORTS = [
+    ('python', 'pass'),
+    ('runtime', 'import pybemhtml.cache, pybemhtml.library, pybemhtml.loader'),
+    ('compiler', 'import pybemhtml.compiler'),
+]
+
+
+def measure(statement, repeat):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+    best = None
+
+    for i in xrange(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement], env=env)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=10)
+    parser.add_option('--budget', type='float', default=250, help='runtime import budget in milliseconds')
+
+    options, args = parser.parse_args()
+
+    results = dict((name, measure(statement, options.repeat)) for name, statement in IMPORTS)
+
+    print '%-10s %10s %10s' % ('import', 'ms', 'over python')
+
+    for name, statement in IMPORTS:
+        print '%-10s %10.1f %10.1f' % (name, results[name] * 1000, (results[name] - results['python']) * 1000)
+
+    overhead = (results['runtime'] - results['python']) * 1000
+
+    if overhead > options.budget:
+        print 'runtime import takes %.1fms, over the %.1fms budget' % (overhead, options.budget)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
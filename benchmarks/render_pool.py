@@ -0,0 +1,66 @@
+# Measures render throughput of RenderPool across worker counts
+#
+#   python benchmarks/render_pool.py [--templates N] [--renders N] [--depth N]
+#                                    [--breadth N] [processes...]
+#
+# Every render is a BEMJSON tree of depth and breadth over the bundle's blocks.
+# Speedup is bounded by the number of cpus.
+
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pybemhtml.compiler import Compiler
+from pybemhtml.library import undefined
+from pybemhtml.pool import RenderPool
+
+from bundles import bundle, tree
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [processes...]')
+    parser.add_option('--templates', type='int', default=100)
+    parser.add_option('--renders', type='int', default=2000)
+    parser.add_option('--depth', type='int', default=3)
+    parser.add_option('--breadth', type='int', default=3)
+
+    options, args = parser.parse_args()
+
+    cpus = multiprocessing.cpu_count()
+    counts = [int(arg) for arg in args] or sorted(set([1, 2, 4, cpus]))
+
+    render = Compiler().compile_to_module(bundle(options.templates)).scope['render']
+
+    bemjson = [tree(options.templates, options.depth, options.breadth, seed=i) for i in xrange(options.renders)]
+    size = len(render(undefined, [bemjson[0]]))
+
+    print '%d cpus, %d bytes of html per render' % (cpus, size)
+    print '%10s %14s %10s' % ('processes', 'renders/sec', 'speedup')
+
+    # Renders in this process, without a pool
+    start = time.time()
+
+    for item in bemjson:
+        render(undefined, [item])
+
+    base = options.renders / (time.time() - start)
+
+    print '%10s %14.0f %10.2f' % ('inline', base, 1)
+
+    for processes in counts:
+        with RenderPool(render, processes) as pool:
+            pool.render(bemjson[:processes])
+
+            start = time.time()
+            pool.render(bemjson, chunksize=max(1, options.renders / (processes * 4)))
+            rate = options.renders / (time.time() - start)
+
+        print '%10d %14.0f %10.2f' % (processes, rate, rate / base)
+
+
+if __name__ == '__main__':
+    main()
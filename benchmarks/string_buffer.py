@@ -0,0 +1,50 @@
+# Measures the buf.push / buf.join rendering pattern on an array and on an
+# OutputSink
+#
+#   python benchmarks/string_buffer.py [--repeat N] [--items N]
+
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pybemhtml.compiler import Compiler
+from pybemhtml.library import JavascriptArray, OutputSink, undefined
+
+
+SOURCE = u"""
+function render(buf, items) {
+    var i = 0;
+
+    while (i < items) {
+        buf.push('<div class="', 'b-block', '">', i, '</div>');
+        i++;
+    }
+
+    return buf.join('');
+}
+"""
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--items', type='int', default=1000)
+
+    options, args = parser.parse_args()
+
+    render = Compiler().compile_to_module(SOURCE).scope['render']
+
+    print '%-14s %12s' % ('buffer', 'us/render')
+
+    for name, factory in (('Array', JavascriptArray), ('OutputSink', lambda: OutputSink(lambda chunk: None))):
+        timer = timeit.Timer(lambda: render(undefined, [factory(), options.items]))
+        best = min(timer.repeat(options.repeat, 10)) / 10
+
+        print '%-14s %12.1f' % (name, best * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Compile time and render throughput benchmarks
+#
+#   python benchmarks/suite.py [--repeat N] [--output FILE] [--compare FILE]
+#
+# --output writes the results as JSON, --compare prints the change against
+# results written earlier, e.g. on another commit.
+
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyjsparser.parser import Parser
+
+from pybemhtml.compiler import Compiler
+from pybemhtml.loader import compile_code, load_module
+from pybemhtml.library import RenderContext, undefined
+
+from bundles import bundle, tree
+
+
+BUNDLES = [50, 200, 800]
+
+# (bundle size, depth, breadth) of the rendered BEMJSON trees
+TREES = [(200, 2, 4), (200, 4, 4), (800, 3, 8)]
+
+
+def best(function, repeat):
+    result = None
+
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+
+        if result is None or elapsed < result:
+            result = elapsed
+
+    return result
+
+
+def compile_benchmarks(repeat):
+    results = {}
+
+    for size in BUNDLES:
+        source = bundle(size)
+        compiler = Compiler()
+
+        python = compiler.compile(source)
+        code = compile_code(python)
+
+        results['bundle-%d' % size] = {
+            'kbytes': len(source) / 1024.0,
+            'parse': best(lambda: Parser().parse(source), repeat),
+            # The optimizer rewrites the tree in place, so give it a fresh one
+            'codegen': best(lambda: compiler.compile_program(Parser().parse(source)), repeat) - best(lambda: Parser().parse(source), repeat),
+            'bytecode': best(lambda: compile_code(python), repeat),
+            'load': best(lambda: load_module(code), repeat),
+        }
+
+    return results
+
+
+def render_benchmarks(repeat):
+    results = {}
+    modules = {}
+
+    for size, depth, breadth in TREES:
+        if size not in modules:
+            modules[size] = Compiler().compile_to_module(bundle(size))
+
+        render = modules[size].scope['render']
+        bemjson = tree(size, depth, breadth)
+
+        def run():
+            with RenderContext():
+                render(undefined, [bemjson])
+
+        elapsed = best(run, repeat)
+
+        results['render-%d-%dx%d' % (size, depth, breadth)] = {
+            'bytes': len(render(undefined, [bemjson]).encode('utf-8')),
+            'renders_per_sec': 1 / elapsed,
+        }
+
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print '%-24s %-16s %12s %12s %8s' % ('benchmark', 'metric', 'baseline', 'current', 'change')
+
+    for name in sorted(results):
+        for metric, value in sorted(results[name].items()):
+            try:
+                previous = baseline[name][metric]
+            except KeyError:
+                continue
+
+            change = (value - previous) / previous * 100 if previous else 0
+
+            print '%-24s %-16s %12.4f %12.4f %+7.1f%%' % (name, metric, previous, value, change)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--output', help='write results as JSON')
+    parser.add_option('--compare', help='compare with results written by --output')
+
+    options, args = parser.parse_args()
+
+    results = {}
+    results.update(compile_benchmarks(options.repeat))
+    results.update(render_benchmarks(options.repeat))
+
+    if options.output:
+        report = {
+            'revision': revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+    else:
+        for name in sorted(results):
+            print name, ' '.join('%s=%.4f' % item for item in sorted(results[name].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# Persistent cache of compiled templates
+
+import errno
+import hashlib
+import imp
+import logging
+import marshal
+import os
+
+from pybemhtml.loader import compile_code, load_module, signature
+
+
+log = logging.getLogger('pybemhtml.cache')
+
+def open_temporary(directory):
+    # Unlike mkstemp the file is created with the mode the process umask
+    # gives, like any other file written by the application
+    while True:
+        tmp = os.path.join(directory, '.tmp%d.%s' % (os.getpid(), os.urandom(6).encode('hex')))
+
+        try:
+            return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def write_atomic(path, data):
+    # Write to a temporary file first, so concurrent readers never see partial files
+    fd, tmp = open_temporary(os.path.dirname(path) or '.')
+
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+        raise
+
+
+# Generated modules and their marshalled bytecode are stored on disk, keyed by
+# a hash of the javascript source, compiler signature and interpreter magic.
+# Least recently used entries are evicted once the cache grows over max_size.
+class CompilerCache(object):
+    def __init__(self, directory, max_size=64 * 1024 * 1024, compiler=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._compiler = compiler
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def compiler(self):
+        # The compiler and its parser are only imported on a cache miss
+        if self._compiler is None:
+            from pybemhtml.compiler import Compiler
+
+            self._compiler = Compiler()
+
+        return self._compiler
+
+    def signature(self):
+        if self._compiler is None:
+            return signature()
+
+        return self._compiler.signature()
+
+    def key(self, js):
+        if isinstance(js, unicode):
+            js = js.encode('utf-8')
+
+        digest = hashlib.sha1()
+        digest.update(self.signature())
+        digest.update(imp.get_magic())
+        digest.update(js)
+
+        return digest.hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def compile(self, js):
+        return self.get(js)[0]
+
+    def compile_code(self, js):
+        return self.get(js)[1]
+
+    def load_module(self, js, name=None):
+        return load_module(self.compile_code(js), name)
+
+    def get(self, js):
+        key = self.key(js)
+
+        entry = self.load(key)
+
+        if entry is not None:
+            return entry
+
+        source = self.compiler.compile(js)
+
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+
+        code = compile_code(source, self.path(key, '.py'))
+
+        self.store(key, source, code)
+
+        return source, code
+
+    def load(self, key):
+        source_path = self.path(key, '.py')
+        code_path = self.path(key, '.pyc')
+
+        try:
+            source = open(source_path, 'rb').read()
+            code = marshal.loads(open(code_path, 'rb').read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        try:
+            os.utime(source_path, None)
+            os.utime(code_path, None)
+        except OSError:
+            pass
+
+        return source, code
+
+    def store(self, key, source, code):
+        self.write(self.path(key, '.py'), source)
+        self.write(self.path(key, '.pyc'), marshal.dumps(code))
+
+        self.evict()
+
+    def write(self, path, data):
+        write_atomic(path, data)
+
+    def entries(self):
+        entries = {}
+
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            key = os.path.splitext(name)[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [path])
+
+        return entries.values()
+
+    def size(self):
+        return sum(size for mtime, size, paths in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, paths in entries)
+
+        for mtime, size, paths in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            log.debug('Evicting %s', paths)
+
+            self.remove(paths)
+
+            total -= size
+
+    def remove(self, paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for mtime, size, paths in self.entries():
+            self.remove(paths)
@@ -0,0 +1,139 @@
+# pybemhtml-compile: compiles a tree of javascript bundles into python modules
+#
+#   pybemhtml-compile [options] SOURCE_DIR OUTPUT_DIR
+
+import hashlib
+import multiprocessing
+import optparse
+import os
+import sys
+
+from pybemhtml.cache import write_atomic
+from pybemhtml.loader import signature
+
+
+# Second line of every generated file, records what it was compiled from
+STAMP = '# pybemhtml-source: %s\n'
+
+
+def source_hash(js, optimize, instrument):
+    digest = hashlib.sha1()
+    digest.update(signature(optimize, instrument))
+    digest.update(js)
+
+    return digest.hexdigest()
+
+
+def read_stamp(path):
+    try:
+        with open(path, 'rb') as generated:
+            generated.readline()
+            return generated.readline()
+    except IOError:
+        return None
+
+
+def compile_file(task):
+    # Runs in the worker processes, returns (source, status, error)
+    source, output, optimize, instrument, force = task
+
+    try:
+        js = open(source, 'rb').read()
+        stamp = STAMP % source_hash(js, optimize, instrument)
+
+        if not force and read_stamp(output) == stamp:
+            return source, 'skipped', None
+
+        from pybemhtml.compiler import Compiler
+
+        python = Compiler(optimize=optimize, instrument=instrument).compile(js.decode('utf-8'))
+
+        if isinstance(python, unicode):
+            python = python.encode('utf-8')
+
+        # The coding declaration has to stay on one of the first two lines
+        header, body = python.split('\n', 1)
+
+        directory = os.path.dirname(output)
+
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        write_atomic(output, header + '\n' + stamp + body)
+    except Exception, e:
+        return source, 'failed', '%s: %s' % (e.__class__.__name__, e)
+
+    return source, 'compiled', None
+
+
+def find_sources(source_dir, output_dir, extension):
+    for directory, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+
+        for filename in sorted(filenames):
+            if not filename.endswith(extension):
+                continue
+
+            source = os.path.join(directory, filename)
+            relative = os.path.relpath(source, source_dir)
+
+            yield source, os.path.join(output_dir, relative[:-len(extension)] + '.py')
+
+
+def compile_tree(source_dir, output_dir, jobs=None, extension='.js', optimize=True, instrument=False, force=False):
+    # Returns (source, status, error) for every bundle, status is one of
+    # compiled, skipped or failed
+    tasks = [(source, output, optimize, instrument, force)
+             for source, output in find_sources(source_dir, output_dir, extension)]
+
+    if jobs == 1 or len(tasks) < 2:
+        return map(compile_file, tasks)
+
+    pool = multiprocessing.Pool(jobs)
+
+    try:
+        return pool.map(compile_file, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] SOURCE_DIR OUTPUT_DIR')
+    parser.add_option('-j', '--jobs', type='int', help='number of worker processes, defaults to the number of cpus')
+    parser.add_option('--extension', default='.js', help='extension of template bundles [%default]')
+    parser.add_option('--no-optimize', dest='optimize', action='store_false', default=True)
+    parser.add_option('--instrument', action='store_true', default=False)
+    parser.add_option('-f', '--force', action='store_true', default=False, help='recompile unchanged bundles')
+    parser.add_option('-q', '--quiet', action='store_true', default=False)
+
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error('expected SOURCE_DIR and OUTPUT_DIR')
+
+    results = compile_tree(args[0], args[1], options.jobs, options.extension,
+                           options.optimize, options.instrument, options.force)
+
+    counts = dict.fromkeys(['compiled', 'skipped', 'failed'], 0)
+
+    for source, status, error in results:
+        counts[status] += 1
+
+        if error:
+            print >>sys.stderr, '%s: %s' % (source, error)
+        elif not options.quiet and status == 'compiled':
+            print source
+
+    if not options.quiet:
+        print '%(compiled)d compiled, %(skipped)d unchanged, %(failed)d failed' % counts
+
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,14 @@
 import logging
 import re
 import sys
+from types import GeneratorType
 
 from pyjsparser import ast
 from pyjsparser.parser import Parser
 
+from pybemhtml.loader import VERSION, compile_code, load_module, signature
+from pybemhtml.sourcemap import SourceMap
+
 
 log = logging.getLogger('bemhtml.compiler')
 
@@ -13,10 +17,132 @@ class CompilerError(Exception):
     pass
 
 
+class Result(object):
+    # Compiled code, yielded by an expression handler when it is done
+    def __init__(self, code):
+        self.code = code
+
+
+class Constant(object):
+    # Value computed at compile time by the optimizer
+    def __init__(self, value):
+        self.value = value
+
+
+# Child fields holding variable references, per node type. Property names,
+# object literal keys and labels are left out, nested function bodies are not
+# entered: they get a lexical scope of their own.
+CHILDREN = {
+    ast.VariableDeclaration: ('expr',),
+    ast.If: ('expr', 'true', 'false'),
+    ast.Assign: ('node', 'expr'),
+    ast.LabelledStatement: ('statement',),
+    ast.Return: ('expression',),
+    ast.Throw: ('expression',),
+    ast.Switch: ('expression', 'cases', 'default'),
+    ast.UnaryOp: ('value',),
+    ast.BinOp: ('left', 'right'),
+    ast.FuncCall: ('node', 'arguments'),
+    ast.ForIn: ('item', 'iterator', 'statement'),
+    ast.While: ('condition', 'statement'),
+    ast.New: ('identifier', 'arguments'),
+    ast.BracketAccessor: ('node', 'element'),
+    ast.DotAccessor: ('node',),
+    ast.Array: ('items',),
+    ast.FuncDecl: (),
+    ast.Identifier: (),
+    ast.Number: (),
+    ast.String: (),
+    ast.Boolean: (),
+    ast.Break: (),
+    ast.Continue: (),
+    Constant: (),
+}
+
+# Switch cases and defaults
+CASE_CHILDREN = ('identifier', 'statements')
+
+
+def walk(nodes):
+    stack = [nodes]
+
+    while stack:
+        node = stack.pop()
+
+        if node is None:
+            continue
+
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+            continue
+
+        yield node
+
+        if isinstance(node, ast.Object):
+            stack.extend(reversed([assignment.expr for assignment in node.properties]))
+            continue
+
+        for field in reversed(CHILDREN.get(type(node), CASE_CHILDREN)):
+            stack.append(getattr(node, field, None))
+
+
+class LexicalScope(object):
+    # Names declared by a javascript function, known at compile time
+    def __init__(self, function):
+        self.parameters = [p.name for p in function.parameters or []]
+        self.declarations = []
+        self.dynamic = False
+        self.arguments = False
+
+        for node in walk(function.statements):
+            if isinstance(node, ast.VariableDeclaration):
+                self.declare(node.node.name)
+            elif isinstance(node, ast.ForIn) and isinstance(node.item, ast.Identifier):
+                # forinloop defines the item in the current scope
+                self.declare(node.item.name)
+            elif isinstance(node, ast.FuncDecl) and node.node:
+                self.declare(node.node.name)
+            elif isinstance(node, ast.Identifier) and node.name == 'eval':
+                self.dynamic = True
+            elif isinstance(node, ast.Identifier) and node.name == 'arguments':
+                self.arguments = True
+
+        self.names = set(self.parameters + self.declarations + ['arguments'])
+
+    def declare(self, name):
+        if name not in self.parameters and name not in self.declarations:
+            self.declarations.append(name)
+
+
+class Target(object):
+    # Statement which break or continue can jump out of. Every target is
+    # compiled into a Python loop; jumps past the innermost loop set a flag
+    # which is checked after each loop on the way out
+    def __init__(self, labels=(), loop=False, switch=False):
+        self.labels = set(labels)
+        self.loop = loop
+        self.switch = switch
+        self.flags = {}
+        self.escapes = []
+
+
+class Location(str):
+    # Empty chunk marking where the code of a javascript statement starts
+    def __new__(cls, position):
+        location = str.__new__(cls, '')
+        location.position = position
+        return location
+
+
 class Stream(object):
+    # Output is kept as a list of chunks and joined once, so emission stays linear
     def __init__(self):
         self._indent = 0
-        self.source = ""
+        self.chunks = []
+
+    @property
+    def source(self):
+        return "".join(self.chunks)
 
     def child(self):
         c = Stream()
@@ -33,52 +159,390 @@ class Stream(object):
             raise Exception("Unexpected dedent")
 
     def write(self, source):
-        self.source += source
+        self.chunks.append(source)
+
+    def mark(self):
+        return len(self.chunks), self._indent
+
+    def insertline(self, mark, line):
+        position, indent = mark
+        self.chunks.insert(position, "    " * indent + line + '\n')
 
     def writeline(self, line):
-        self.source += "    " * self._indent + line + '\n'
+        self.chunks.append("    " * self._indent + line + '\n')
+
+    def locate(self, node):
+        line = getattr(node, 'lineno', None)
+
+        if line is not None:
+            self.chunks.append(Location((line, getattr(node, 'column', None))))
+
+    def wrote(self, position):
+        # Whether any code was written after the position
+        return any(self.chunks[position:])
 
 
 class Compiler(object):
-    def __init__(self):
-        pass
+    def __init__(self, optimize=True, instrument=False):
+        self.optimize = optimize
+        self.instrument = instrument
+
+    def signature(self):
+        return signature(self.optimize, self.instrument)
+
+    def compile(self, js, output=None, filename=None):
+        return self.compile_program(Parser().parse(js), output, filename)
+
+    def compile_program(self, program, output=None, filename=None):
+        # Functions are written out as soon as they are finished, either into
+        # the output file-like object or into the returned string
+        if output is None:
+            chunks = []
+            self.output = chunks.append
+        else:
+            self.output = output.write
 
-    def compile(self, js):
-        self.functions = []
         self.name_counter = 0
-        self.label = None
-        self.labels = set()
-
-        program = Parser().parse(js)
+        self.targets = []
+        self.scopes = []
+        self.source_map = SourceMap(filename)
+        self.line = 0
 
         assert isinstance(program, ast.Program)
 
+        if self.optimize:
+            self.optimize_statements(program.statements)
+
         preamble = Stream()
 
         preamble.writeline('# -*- coding: utf-8 -*-')
         preamble.writeline('from pybemhtml.library import *')
+        preamble.writeline('scope = GlobalScope()')
+
+        self.emit(preamble)
 
         self.stream = Stream()
 
-        self.compile_statements(program.statements, self.stream, program=True)
+        self.compile_statements(program.statements, self.stream)
+
+        self.emit(self.stream)
+
+        if output is None:
+            return "".join(chunks)
+
+    def emit(self, stream):
+        line = self.line
+
+        for chunk in stream.chunks:
+            if chunk.__class__ is Location:
+                self.source_map.lines[line + 1] = chunk.position
+            else:
+                line += chunk.count('\n')
+
+        self.line = line + 1
+        self.output(stream.source + '\n')
+
+    def define_constant(self, prefix, value):
+        # Module level value, computed once when the module is loaded
+        name = self.generate_name(prefix)
+        self.line += value.count('\n') + 2
+        self.output('%s = %s\n\n' % (name, value))
+        return name
+
+    def finish_function(self, stream):
+        self.emit(stream)
 
-        for f in self.functions:
-            f.writeline('return undefined')
+    def compile_to_module(self, js, name=None, filename=None):
+        code = compile_code(self.compile(js, filename=filename), '<%s>' % (name or 'pybemhtml'))
 
-        self.functions.append(self.stream)
+        module = load_module(code, name)
+        module.__source_map__ = self.source_map
 
-        return "\n".join(f.source for f in [preamble] + self.functions)
+        return module
 
     def generate_name(self, prefix='f'):
         name = '%s%s' % (prefix, self.name_counter)
         self.name_counter += 1
         return name
 
+    NUMBER = re.compile(r'^(0|[1-9][0-9]*)(\.[0-9]+)?$')
+
+    FOLDABLE = {
+        '+': lambda a, b: a + b,
+        '-': lambda a, b: a - b,
+        '*': lambda a, b: a * b,
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '===': lambda a, b: a == b,
+        '!==': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '>': lambda a, b: a > b,
+        '<=': lambda a, b: a <= b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def optimize_statements(self, statements):
+        # Post-order traversal replacing every node after its children, with
+        # an explicit stack of (container, key) slots
+        stack = [(statements, index, False) for index in reversed(xrange(len(statements)))]
+
+        while stack:
+            container, key, visited = stack.pop()
+
+            if isinstance(container, list):
+                node = container[key]
+            else:
+                node = getattr(container, key)
+
+            if visited:
+                optimized = self.optimize_expression(node)
+
+                # is_string picks the coercion of +, so a replacement must not
+                # change it: ('' ? '' : '') + true raises like the generated code
+                if optimized is not node and self.is_string(optimized) == self.is_string(node):
+                    if isinstance(container, list):
+                        container[key] = optimized
+                    else:
+                        setattr(container, key, optimized)
+
+                continue
+
+            stack.append((container, key, True))
+
+            for slot in reversed(self.optimizable_children(node)):
+                stack.append(slot + (False,))
+
+    def optimizable_children(self, node):
+        if isinstance(node, list):
+            return [(node, index) for index, child in enumerate(node) if child is not None]
+
+        if isinstance(node, ast.Object):
+            return [(assignment, 'expr') for assignment in node.properties]
+
+        if isinstance(node, ast.FuncDecl):
+            fields = ('statements',)
+        elif isinstance(node, ast.Switch):
+            slots = [(node, 'expression')]
+
+            for case in node.cases:
+                slots.extend([(case, 'identifier'), (case, 'statements')])
+
+            if node.default:
+                slots.append((node.default, 'statements'))
+
+            return slots
+        else:
+            fields = CHILDREN.get(type(node), ())
+
+        return [(node, field) for field in fields if getattr(node, field, None) is not None]
+
+    def literal(self, expr):
+        # Returns (True, value) for expressions with a value known at compile time
+        if isinstance(expr, Constant):
+            return True, expr.value
+
+        if isinstance(expr, ast.String):
+            return True, self.unescape_string(expr)
+
+        if isinstance(expr, ast.Boolean):
+            return True, expr.value == 'true'
+
+        if isinstance(expr, ast.Number) and self.NUMBER.match(expr.value):
+            if '.' in expr.value:
+                return True, float(expr.value)
+
+            return True, int(expr.value)
+
+        return False, None
+
+    LITERAL_PATTERN = re.compile(r'^(?:[^\\.^$*+?()[\]{}|/]|\\[^A-Za-z0-9])+$')
+
+    def literal_replacement(self, expr):
+        # Returns (old, new) for s.replace(new RegExp("x", "g"), "y") calls
+        # replacing every occurrence of a literal string with a literal string
+        if not (isinstance(expr, ast.FuncCall) and isinstance(expr.node, ast.DotAccessor)):
+            return None
+
+        if expr.node.element.name != 'replace' or len(expr.arguments or []) != 2:
+            return None
+
+        pattern, replacement = expr.arguments
+
+        if not isinstance(pattern, ast.New) or not self.is_constant_regexp(pattern) or len(pattern.arguments) != 2:
+            return None
+
+        source, flags = [self.literal(arg)[1] for arg in pattern.arguments]
+        known, new = self.literal(replacement)
+
+        if flags != 'g' or not self.LITERAL_PATTERN.match(source):
+            return None
+
+        if not known or not isinstance(new, basestring) or '$' in new:
+            return None
+
+        return re.sub(r'\\(.)', r'\1', source), new
+
+    def compile_escape(self, expr):
+        # Chains of literal replacements, the way xjst templates escape html,
+        # become a single call of the native escape_string
+        replacements = []
+
+        while True:
+            replacement = self.literal_replacement(expr)
+
+            if replacement is None:
+                break
+
+            replacements.append(tuple(unicode(part) for part in replacement))
+            expr = expr.node.node
+
+        if not replacements:
+            return None
+
+        return 'escape_string(%s,%r)' % (self.compile_expression(expr), tuple(reversed(replacements)))
+
+    def is_constant_regexp(self, expr):
+        if not (isinstance(expr.identifier, ast.Identifier) and expr.identifier.name == 'RegExp'):
+            return False
+
+        if self.resolve('RegExp') is not None or not 1 <= len(expr.arguments or []) <= 2:
+            return False
+
+        for argument in expr.arguments:
+            known, value = self.literal(argument)
+
+            if not known or not isinstance(value, basestring):
+                return False
+
+        return True
+
+    def is_string(self, expr):
+        # Whether expr is known to evaluate to a string: a string literal or
+        # a concatenation with one
+        stack = [expr]
+
+        while stack:
+            expr = stack.pop()
+
+            if isinstance(expr, ast.BinOp) and expr.operator == '+':
+                stack.extend((expr.left, expr.right))
+            elif isinstance(expr, ast.String) or (isinstance(expr, Constant) and isinstance(expr.value, basestring)):
+                return True
+
+        return False
+
     def optimize_expression(self, expr):
-        pass
+        # Simplifies a node whose children are already optimized, returns the
+        # replacement node or expr itself. The result must evaluate exactly as
+        # the generated code for expr would.
+        if isinstance(expr, ast.BinOp):
+            known, left = self.literal(expr.left)
+
+            if not known:
+                return expr
+
+            if expr.operator == '&&':
+                return expr.right if left else expr.left
+
+            if expr.operator == '||':
+                return expr.left if left else expr.right
+
+            known, right = self.literal(expr.right)
+
+            if not known or expr.operator not in self.FOLDABLE:
+                return expr
+
+            if expr.operator == '+':
+                # Same coercion as in compile_expression
+                if self.is_string(expr.left):
+                    right = unicode(right)
+                elif self.is_string(expr.right):
+                    left = unicode(left)
+
+            if expr.operator in ('+', '-', '*') and (isinstance(left, bool) or isinstance(right, bool)):
+                return expr
+
+            if expr.operator in ('-', '*') and (isinstance(left, basestring) or isinstance(right, basestring)):
+                return expr
+
+            try:
+                return Constant(self.FOLDABLE[expr.operator](left, right))
+            except TypeError:
+                return expr
+
+        if isinstance(expr, ast.UnaryOp):
+            known, value = self.literal(expr.value)
+
+            if known and expr.operator == '!':
+                return Constant(not value)
+
+            if known and expr.operator == '-' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                return Constant(-value)
+
+            return expr
+
+        if isinstance(expr, ast.If):
+            self.optimize_condition(expr, 'expr')
+
+            known, value = self.literal(expr.expr)
+
+            if not known:
+                return expr
+
+            taken, dropped = (expr.true, expr.false) if value else (expr.false, expr.true)
+
+            # Removed branches still declare their variables
+            if any(isinstance(node, (ast.VariableDeclaration, ast.FuncDecl, ast.ForIn)) for node in walk(dropped)):
+                return expr
+
+            if taken is None:
+                return []
+
+            return taken
+
+        if isinstance(expr, ast.While):
+            self.optimize_condition(expr, 'condition')
+
+        return expr
+
+    def optimize_condition(self, node, field):
+        # Only truthiness of conditions matters, so double negation is dropped
+        condition = getattr(node, field)
+
+        while isinstance(condition, ast.UnaryOp) and condition.operator == '!' and isinstance(condition.value, ast.UnaryOp) and condition.value.operator == '!':
+            condition = condition.value.value
+
+        setattr(node, field, condition)
+
+    def resolve(self, name):
+        # Returns how many scopes up the variable is declared, or None when
+        # it can only be looked up at runtime
+        for depth, scope in enumerate(reversed(self.scopes)):
+            if scope.dynamic:
+                return None
+
+            if name in scope.names:
+                return depth
+
+        return None
+
+    def is_reference(self, expr):
+        # this and resolved variables evaluate to a local or dict lookup without side effects
+        if expr == 'this':
+            return True
+
+        return isinstance(expr, ast.Identifier) and self.resolve(expr.name) is not None
+
+    def compile_variables(self, depth):
+        return 'scope%s.variables' % ('.parent' * depth)
 
     def compile_assignment(self, lvalue, *args):
         if isinstance(lvalue, ast.Identifier):
+            depth = self.resolve(lvalue.name)
+
+            if depth is not None:
+                return "setvariable(%s, %r, %s)" % ((self.compile_variables(depth), lvalue.name) + args)
+
             return ("scope.__setitem__(%s, %s)") % ((repr(lvalue.name),) + args)
         elif isinstance(lvalue, ast.PropertyAccessor):
             node = self.compile_expression(lvalue.node)
@@ -91,8 +555,24 @@ class Compiler(object):
         else:
             raise CompilerError("Cannot assign to %r" % lvalue)
 
+    def compile_store(self, lvalue, value, stream):
+        # Assignment as a statement, resolved variables need no function call
+        if isinstance(lvalue, ast.Identifier):
+            depth = self.resolve(lvalue.name)
+
+            if depth is not None:
+                stream.writeline('%s[%r] = %s' % (self.compile_variables(depth), lvalue.name, value))
+                return
+
+        stream.writeline(self.compile_assignment(lvalue, value))
+
     def compile_update(self, lvalue, function, postfix, *args):
         if isinstance(lvalue, ast.Identifier):
+            depth = self.resolve(lvalue.name)
+
+            if depth is not None:
+                return "updatevariable(%s, %r, %s, postfix=%s)" % (self.compile_variables(depth), lvalue.name, function, 'True' if postfix else 'False')
+
             return "scope.update(%s, %s, postfix=%s)" % (repr(lvalue.name), function, 'True' if postfix else 'False')
         elif isinstance(lvalue, ast.PropertyAccessor):
             node = self.compile_expression(lvalue.node)
@@ -131,153 +611,331 @@ class Compiler(object):
 
         parameters = [repr(p.name) for p in expr.parameters or []]
 
-        if name:
-            return "Function(%s,[%s],scope,%r)" % (self.compile_statements(expr.statements), ','.join(parameters), name)        
-        else:
-            return "Function(%s,[%s],scope)" % (name, self.compile_statements(expr.statements), ','.join(parameters))     
+        lexical = LexicalScope(expr)
+        declarations = [repr(d) for d in lexical.declarations]
+
+        # Jump targets do not cross function boundaries
+        targets, self.targets = self.targets, []
+
+        self.scopes.append(lexical)
+        code = self.compile_statements(expr.statements)
+        self.scopes.pop()
+
+        # Anonymous functions keep the generated name to stay apart in profiles
+        js_name = name if expr.node else u'%s@%s' % (name, code)
+
+        self.source_map.functions[code] = (js_name, getattr(expr, 'lineno', None), getattr(expr, 'column', None))
+
+        self.targets = targets
+
+        function = 'InstrumentedFunction' if self.instrument else 'Function'
+
+        if lexical.arguments or lexical.dynamic:
+            return "%s(%s,[%s],scope,%r,[%s])" % (function, code, ','.join(parameters), name, ','.join(declarations))
+
+        # Lean call path, no arguments object is built
+        return "%s(%s,[%s],scope,%r,[%s],arguments=False)" % (function, code, ','.join(parameters), name, ','.join(declarations))
 
     def compile_expression(self, expr):
-        if isinstance(expr, list):
-            assert len(expr) == 1
-            return self.compile_expression(expr[0])
-
-        if isinstance(expr, ast.FuncDecl):
-            compiled = self.compile_function(expr)
-            
-            if expr.node:
-                return self.compile_assignment(expr.node, compiled)
-
-            return compiled
-                
-        if isinstance(expr, ast.UnaryOp):
-            operator = expr.operator
+        # Handlers of nested expressions are generators, yielding the child
+        # nodes they need compiled and receiving the code back. They are
+        # driven with an explicit stack, so nesting depth is not limited by
+        # the python stack.
+        stack = []
+        value = self.start_expression(expr)
+
+        while True:
+            if isinstance(value, GeneratorType):
+                stack.append(value)
+                value = None
+            elif not stack:
+                return value
+
+            item = stack[-1].send(value)
+
+            if isinstance(item, Result):
+                stack.pop()
+                value = item.code
+            else:
+                value = self.start_expression(item)
 
-            if operator == '!':
-                operator = 'not'
+    def start_expression(self, expr):
+        # Returns the code of a leaf, or the generator of a nested expression
+        handler = self.EXPRESSIONS.get(expr.__class__)
 
-            if operator == '--':
-                return self.compile_update(expr.value, "decr", postfix=expr.postfix)
+        if handler is None:
+            handler = self.find_expression_handler(expr)
 
-            if operator == '++':
-                return self.compile_update(expr.value, "incr", postfix=expr.postfix)
+        return handler(self, expr)
 
-            if operator == 'delete':
-                return self.compile_delete(expr.value)
+    def find_expression_handler(self, expr):
+        # Subclasses of the node types
+        for cls, handler in self.EXPRESSIONS.items():
+            if isinstance(expr, cls):
+                return handler
 
-            return "(%s(%s))" % (operator, self.compile_expression(expr.value))
+        raise Exception("Unexpected node %r" % expr)
 
-        if isinstance(expr, ast.BinOp):
-            operator = expr.operator
+    def expression_list(self, expr):
+        assert len(expr) == 1
+
+        yield Result((yield expr[0]))
+
+    def expression_function(self, expr):
+        compiled = self.compile_function(expr)
+
+        if expr.node:
+            return self.compile_assignment(expr.node, compiled)
+
+        return compiled
+
+    def expression_unary(self, expr):
+        operator = expr.operator
+
+        if operator == '!':
+            operator = 'not'
+
+        if operator == '--':
+            yield Result(self.compile_update(expr.value, "decr", postfix=expr.postfix))
+            return
+
+        if operator == '++':
+            yield Result(self.compile_update(expr.value, "incr", postfix=expr.postfix))
+            return
+
+        if operator == 'delete':
+            yield Result(self.compile_delete(expr.value))
+            return
 
-            if operator == '===': # hack
-                operator = '=='
+        yield Result("(%s(%s))" % (operator, (yield expr.value)))
 
-            if operator == '!==':
-                operator = '!='
-            
-            if operator == '&&':
-                operator = 'and'
+    OPERATORS = {
+        '===': '==', # hack
+        '!==': '!=',
+        '&&': 'and',
+        '||': 'or',
+    }
 
-            if operator == '||':
-                operator = 'or'
+    # Operators compiled without parentheses when chained, python evaluates
+    # them left to right just like javascript. Comparisons are left out, python
+    # chains them differently.
+    CHAINED = ('+', '-', '*', '&&', '||')
+
+    def expression_binop(self, expr):
+        operator = self.OPERATORS.get(expr.operator, expr.operator)
+
+        if expr.operator not in self.CHAINED:
+            left = yield expr.left
+            right = yield expr.right
+
+            yield Result("(%s %s %s)" % (left, operator, right))
+            return
+
+        # Left nested chain of one operator, (a && b) && c is compiled as
+        # (a and b and c), python can not parse deeply nested parentheses
+        operands = []
+        chained = expr.operator
+
+        while isinstance(expr, ast.BinOp) and expr.operator == chained:
+            operands.append(expr.right)
+            expr = expr.left
+
+        operands.append(expr)
+        operands.reverse()
+
+        parts = [(yield operands[0])]
+        string = chained == '+' and self.is_string(operands[0])
+
+        for operand in operands[1:]:
+            code = yield operand
 
             # Javascript coercion to string
-            if operator == '+':
-                if isinstance(expr.left, ast.String):
-                    return '%s + unicode(%s)' % (self.compile_string(expr.left), self.compile_expression(expr.right))
-                if isinstance(expr.right, ast.String):
-                    return 'unicode(%s) + %s' % (self.compile_expression(expr.left), self.compile_string(expr.right))
+            if string:
+                code = 'unicode(%s)' % code
+            elif chained == '+' and self.is_string(operand):
+                parts = ['unicode(%s)' % ' + '.join(parts)]
+                string = True
 
-            return "(%s %s %s)" % (self.compile_expression(expr.left), operator, self.compile_expression(expr.right))
+            parts.append(code)
 
-        if isinstance(expr, ast.Assign):
-            return self.compile_assignment(expr.node, self.compile_expression(expr.expr))
+        yield Result("(%s)" % (' %s ' % operator).join(parts))
 
-        if isinstance(expr, ast.FuncCall):
-            args = map(self.compile_expression, expr.arguments or [])
+    def expression_assign(self, expr):
+        yield Result(self.compile_assignment(expr.node, (yield expr.expr)))
 
-            if isinstance(expr.node, ast.PropertyAccessor):
-                instance = self.compile_expression(expr.node.node)
-            else:
-                instance = 'undefined'
+    def expression_call(self, expr):
+        escape = self.compile_escape(expr)
 
-            return "%s(%s,[%s])" % (self.compile_expression(expr.node), instance, ",".join(args))
+        if escape is not None:
+            yield Result(escape)
+            return
 
-        if isinstance(expr, ast.Object):
-            properties = []
+        args = []
 
-            for assignment in expr.properties:
-                assert isinstance(assignment, ast.Assign) and assignment.operator == ':'
+        for argument in expr.arguments or []:
+            args.append((yield argument))
 
-                if isinstance(assignment.node, ast.Identifier):
-                    key = repr(assignment.node.name)
-                elif isinstance(assignment.node, ast.String):
-                    key = self.compile_string(assignment.node)
-                elif isinstance(assignment.node, ast.Number):
-                    key = repr(assignment.node.value)
-                else:
-                    assert False
-                
-                properties.append("%s:%s" % (key, self.compile_expression(assignment.expr)))
-                
-            return "{%s}" % ",".join(properties)
+        if isinstance(expr.node, ast.PropertyAccessor):
+            instance = yield expr.node.node
+        else:
+            instance = 'undefined'
 
-        if isinstance(expr, ast.Boolean):
-            if expr.value == 'true':
-                return 'True'
-            elif expr.value == 'false':
-                return 'False'
+        yield Result("%s(%s,[%s])" % ((yield expr.node), instance, ",".join(args)))
+
+    def expression_object(self, expr):
+        properties = []
+
+        for assignment in expr.properties:
+            assert isinstance(assignment, ast.Assign) and assignment.operator == ':'
+
+            if isinstance(assignment.node, ast.Identifier):
+                key = repr(assignment.node.name)
+            elif isinstance(assignment.node, ast.String):
+                key = self.compile_string(assignment.node)
+            elif isinstance(assignment.node, ast.Number):
+                key = repr(assignment.node.value)
             else:
                 assert False
 
-        if isinstance(expr, ast.If):
-            return '(%s if %s else %s)' % (self.compile_expression(expr.true), self.compile_expression(expr.expr), self.compile_expression(expr.false))
+            properties.append("%s:%s" % (key, (yield assignment.expr)))
 
-        if isinstance(expr, ast.ForIn):
-            assert isinstance(expr.item, ast.Identifier)
-            
-            return 'forinloop(this,scope,%r,%s,%s)' % (expr.item.name, self.compile_expression(expr.iterator), self.compile_statements([expr.statement]))
+        yield Result("{%s}" % ",".join(properties))
 
-        if isinstance(expr, ast.While):
-            return 'whileloop(this,scope,lambda scope:%s,%s)' % (self.compile_expression(expr.condition), self.compile_statements([expr.statement]))
+    def expression_boolean(self, expr):
+        if expr.value == 'true':
+            return 'True'
+        elif expr.value == 'false':
+            return 'False'
+        else:
+            assert False
 
-        if isinstance(expr, ast.New):
-            return 'new(%s,[%s])' % (self.compile_expression(expr.identifier), ','.join(self.compile_expression(arg) for arg in expr.arguments))
+    # Longest conditional compiled to a python conditional expression
+    CONDITIONAL_CHAIN = 100
 
-        if isinstance(expr, ast.Number):
-            return '%s' % expr.value
+    def expression_conditional(self, expr):
+        # Conditionals nested in the else branch are chained without
+        # parentheses, as xjst generates long ones: (a if x else b if y else c)
+        branches = []
 
-        if isinstance(expr, ast.BracketAccessor):
-            return 'getproperty(%s,%s)' % (self.compile_expression(expr.node), self.compile_expression(expr.element))
+        while isinstance(expr, ast.If):
+            true = yield expr.true
+            condition = yield expr.expr
 
-        if isinstance(expr, ast.DotAccessor):
-            assert isinstance(expr.element, ast.Identifier)
-            return 'getproperty(%s,%r)' % (self.compile_expression(expr.node), expr.element.name)
+            branches.append((condition, true))
 
-        if isinstance(expr, ast.String):
-            return self.compile_string(expr)
+            expr = expr.false
 
-        if isinstance(expr, ast.Identifier):
-            if expr.name == 'undefined':
-                return 'undefined'
+        false = yield expr
 
-            return "scope[%r]" % expr.name
+        if len(branches) <= self.CONDITIONAL_CHAIN:
+            yield Result('(%s%s)' % (''.join('%s if %s else ' % (true, condition) for condition, true in branches), false))
+            return
 
-        if isinstance(expr, ast.Array):
-            return "[%s]" % ','.join(map(self.compile_expression, expr.items or []))
+        # The python parser still nests every else branch, longer chains are
+        # flattened to (x and (a,) or y and (b,) or (c,))[0]
+        yield Result('(%s or (%s,))[0]' % (' or '.join('%s and (%s,)' % branch for branch in branches), false))
 
-        if expr == 'this':
-            return "this"
+    def expression_new(self, expr):
+        if self.is_constant_regexp(expr):
+            # Built once when the module is loaded, like a regexp literal
+            arguments = [self.literal(arg)[1] for arg in expr.arguments]
+            yield Result(self.define_constant('regexp', 'RegExp(%s)' % ','.join(repr(unicode(arg)) for arg in arguments)))
+            return
+
+        identifier = yield expr.identifier
+        args = []
+
+        for argument in expr.arguments:
+            args.append((yield argument))
+
+        yield Result('new(%s,[%s])' % (identifier, ','.join(args)))
+
+    def expression_number(self, expr):
+        return '%s' % expr.value
+
+    def expression_bracket(self, expr):
+        node = yield expr.node
+
+        yield Result('getproperty(%s,%s)' % (node, (yield expr.element)))
+
+    def expression_dot(self, expr):
+        assert isinstance(expr.element, ast.Identifier)
+
+        node = yield expr.node
+
+        if self.is_reference(expr.node):
+            # Inline lookup for plain dicts, the node is cheap to evaluate repeatedly
+            yield Result('(%s[%r] if type(%s) is dict and %r in %s else getnamedproperty(%s,%r))' % (node, expr.element.name, node, expr.element.name, node, node, expr.element.name))
+            return
+
+        yield Result('getnamedproperty(%s,%r)' % (node, expr.element.name))
+
+    def expression_string(self, expr):
+        return self.compile_string(expr)
+
+    def expression_constant(self, expr):
+        return repr(expr.value)
 
-        if expr is None:
+    def expression_identifier(self, expr):
+        if expr.name == 'undefined':
             return 'undefined'
 
-        raise Exception("Unexpected node %r" % expr)
+        depth = self.resolve(expr.name)
+
+        if depth is not None:
+            return "%s[%r]" % (self.compile_variables(depth), expr.name)
+
+        return "scope[%r]" % expr.name
+
+    def expression_array(self, expr):
+        items = []
+
+        for item in expr.items or []:
+            items.append((yield item))
+
+        yield Result("JavascriptArray([%s])" % ','.join(items))
+
+    def expression_this(self, expr):
+        if expr != 'this':
+            raise Exception("Unexpected node %r" % expr)
+
+        return "this"
+
+    def expression_undefined(self, expr):
+        return 'undefined'
+
+    # Expression handlers by node type, looked up once per node instead of
+    # testing every type in turn
+    EXPRESSIONS = {
+        list: expression_list,
+        ast.FuncDecl: expression_function,
+        ast.UnaryOp: expression_unary,
+        ast.BinOp: expression_binop,
+        ast.Assign: expression_assign,
+        ast.FuncCall: expression_call,
+        ast.Object: expression_object,
+        ast.Boolean: expression_boolean,
+        ast.If: expression_conditional,
+        ast.New: expression_new,
+        ast.Number: expression_number,
+        ast.BracketAccessor: expression_bracket,
+        ast.DotAccessor: expression_dot,
+        ast.String: expression_string,
+        Constant: expression_constant,
+        ast.Identifier: expression_identifier,
+        ast.Array: expression_array,
+        str: expression_this,
+        unicode: expression_this,
+        type(None): expression_undefined,
+    }
 
     UNESCAPE = re.compile(r'\\(u[0-9a-f]{4}|.)', re.U)
 
     def compile_string(self, string):
         # Unescaping and then escaping to be safe
+        return repr(self.unescape_string(string))
+
+    def unescape_string(self, string):
         def replacement(match):
             text = match.group(1)
 
@@ -292,35 +950,223 @@ class Compiler(object):
 
             raise CompilerError("Unknown escaped character \\%s" % text)
 
-        return repr(self.UNESCAPE.sub(replacement, string.data[1:-1]))
+        return self.UNESCAPE.sub(replacement, string.data[1:-1])
 
-    def compile_statements(self, statements, stream=None, program=False, label=None):
+    def compile_statements(self, statements, stream=None):
         if not stream:
             name = self.generate_name()
             stream = self.stream.child()
-            self.functions.append(stream)
             stream.writeline('def %s(this,scope):' % name)
             stream.indent()
         else:
             name = None
 
-        if statements is None:
-            return name
-
-        assert isinstance(statements, list)
+        if statements is not None:
+            assert isinstance(statements, list)
 
-        for statement in statements:
-            self.compile_statement(statement, stream, program)
+            for statement in statements:
+                self.compile_statement(statement, stream)
 
         if name:
-            if label:
-                stream.writeline('return Label(%r)' % label)
-            else:
+            if not (statements and self.is_terminated(statements)):
                 stream.writeline('return undefined')
 
+            self.finish_function(stream)
+
         return name
 
-    def compile_statement(self, statement, stream=None, program=False):
+    def compile_block(self, statements, stream):
+        # Python blocks can not be empty
+        position = len(stream.chunks)
+
+        stream.indent()
+
+        self.compile_statement(statements, stream)
+
+        if not stream.wrote(position):
+            stream.writeline('pass')
+
+        stream.dedent()
+
+    def open_target(self, stream, labels=(), loop=False, switch=False):
+        target = Target(labels, loop, switch)
+        target.mark = stream.mark()
+
+        self.targets.append(target)
+
+        return target
+
+    def close_target(self, stream):
+        target = self.targets.pop()
+
+        for kind, destination in target.escapes:
+            flag = destination.flags[kind]
+
+            stream.writeline('if %s:' % flag)
+            stream.indent()
+
+            if self.targets and self.targets[-1] is destination:
+                if kind == 'continue':
+                    stream.writeline('%s = False' % flag)
+
+                stream.writeline(kind)
+            else:
+                stream.writeline('break')
+
+            stream.dedent()
+
+        # Flags are initialized before the loop, once it is known which are used
+        for kind, flag in sorted(target.flags.items()):
+            stream.insertline(target.mark, '%s = False' % flag)
+
+    def find_target(self, kind, label):
+        for target in reversed(self.targets):
+            if label is not None:
+                if label in target.labels:
+                    if kind == 'continue' and not target.loop:
+                        raise CompilerError("Label %s does not denote a loop" % label)
+
+                    return target
+            elif target.loop or (kind == 'break' and target.switch):
+                return target
+
+        if label is not None:
+            raise CompilerError("Undefined label %s" % label)
+
+        raise CompilerError("%s outside of a loop" % kind)
+
+    def compile_jump(self, kind, identifier, stream):
+        label = None
+
+        if isinstance(identifier, ast.Identifier):
+            label = identifier.name
+
+        target = self.find_target(kind, label)
+
+        if target is self.targets[-1]:
+            stream.writeline(kind)
+            return
+
+        if kind not in target.flags:
+            target.flags[kind] = self.generate_name(kind)
+
+        stream.writeline('%s = True' % target.flags[kind])
+        stream.writeline('break')
+
+        for inner in self.targets[self.targets.index(target) + 1:]:
+            if (kind, target) not in inner.escapes:
+                inner.escapes.append((kind, target))
+
+    def compile_loop(self, statement, stream, labels=()):
+        self.open_target(stream, labels, loop=True)
+
+        if isinstance(statement, ast.While):
+            stream.writeline('while %s:' % self.compile_expression(statement.condition))
+            self.compile_block(statement.statement, stream)
+        else:
+            assert isinstance(statement.item, ast.Identifier)
+
+            name = self.generate_name('property')
+
+            stream.writeline('for %s in enumerate_properties(%s):' % (name, self.compile_expression(statement.iterator)))
+            stream.indent()
+            self.compile_store(statement.item, name, stream)
+            stream.dedent()
+            self.compile_block(statement.statement, stream)
+
+        self.close_target(stream)
+
+    def compile_table_switch(self, statement, stream):
+        # All cases are literals: the matching case is found with a single
+        # lookup in a module level dict of case values to case indexes
+        bodies = []
+        table = {}
+        keys = []
+
+        for case in statement.cases:
+            # Keyed by value, 1 and 1.0 are the same case and the first wins
+            constant = self.literal(case.identifier)[1]
+
+            if constant not in table:
+                keys.append((constant, self.compile_expression(case.identifier)))
+
+                # Cases without statements share the body of the next case
+                table[constant] = len(bodies)
+
+            if case.statements:
+                bodies.append(case.statements)
+
+        default = len(bodies)
+
+        bodies.append(statement.default.statements if statement.default else [])
+
+        table_name = self.define_constant('cases', '{%s}' % ','.join('%s:%d' % (key, min(table[constant], default)) for constant, key in keys))
+
+        value = self.generate_name('value')
+        name = self.generate_name('case')
+
+        stream.writeline('%s = %s' % (value, self.compile_expression(statement.expression)))
+
+        # Only the lookup is guarded, unhashable values match no case
+        stream.writeline('try:')
+        stream.indent()
+        stream.writeline('%s = %s.get(%s, %d)' % (name, table_name, value, default))
+        stream.dedent()
+        stream.writeline('except TypeError:')
+        stream.indent()
+        stream.writeline('%s = %d' % (name, default))
+        stream.dedent()
+
+        self.open_target(stream, switch=True)
+
+        stream.writeline('while True:')
+        stream.indent()
+
+        if all(self.is_terminated(body) for body in bodies[:default]):
+            # Without fallthrough exactly one body runs, pick it by bisection
+            self.compile_dispatch(name, bodies, 0, len(bodies), stream)
+        else:
+            for index, body in enumerate(bodies[:default]):
+                stream.writeline('if %s <= %d:' % (name, index))
+                self.compile_block(body, stream)
+
+            self.compile_statements(bodies[default], stream)
+
+        stream.writeline('break')
+        stream.dedent()
+
+        self.close_target(stream)
+
+    def compile_dispatch(self, name, bodies, low, high, stream):
+        if high - low == 1:
+            position = len(stream.chunks)
+
+            self.compile_statements(bodies[low], stream)
+
+            if not stream.wrote(position):
+                stream.writeline('pass')
+
+            return
+
+        middle = (low + high) // 2
+
+        stream.writeline('if %s < %d:' % (name, middle))
+        stream.indent()
+        self.compile_dispatch(name, bodies, low, middle, stream)
+        stream.dedent()
+        stream.writeline('else:')
+        stream.indent()
+        self.compile_dispatch(name, bodies, middle, high, stream)
+        stream.dedent()
+
+    def is_terminated(self, statements):
+        # Whether control never falls off the end of the statements
+        while isinstance(statements, list) and statements:
+            statements = statements[-1]
+
+        return isinstance(statements, (ast.Break, ast.Continue, ast.Return, ast.Throw))
+
+    def compile_statement(self, statement, stream=None):
         if statement is None:
             return
 
@@ -328,69 +1174,96 @@ class Compiler(object):
             self.compile_statements(statement, stream)
             return
 
+        stream.locate(statement)
+
         if isinstance(statement, ast.VariableDeclaration):
-            # TODO: declaring variable affects whole scope, even if declaration is not executed
             assert isinstance(statement.node, ast.Identifier)
 
-            stream.writeline('scope.var(%s,%s)' % (repr(statement.node.name), self.compile_expression(statement.expr)))
+            depth = self.resolve(statement.node.name)
+
+            if depth is None:
+                stream.writeline('scope.var(%s,%s)' % (repr(statement.node.name), self.compile_expression(statement.expr)))
+            elif statement.expr is not None:
+                # Declared variables are hoisted by Function, so this is a plain assignment
+                self.compile_store(statement.node, self.compile_expression(statement.expr), stream)
+
             return
 
         if isinstance(statement, ast.If):
-            expression = self.compile_expression(statement.expr)
+            keyword = 'if'
 
-            stream.writeline('if %s:' % expression)
+            while True:
+                expression = self.compile_expression(statement.expr)
 
-            stream.indent()
-            self.compile_statement(statement.true, stream)
-            stream.dedent()
+                stream.writeline('%s %s:' % (keyword, expression))
+
+                self.compile_block(statement.true, stream)
+
+                false = statement.false
+
+                if isinstance(false, list) and len(false) == 1:
+                    false = false[0]
+
+                # else if chains become elif, python limits nesting of blocks
+                if not isinstance(false, ast.If):
+                    break
 
-            if statement.false:
+                stream.locate(false)
+
+                statement = false
+                keyword = 'elif'
+
+            if false:
                 stream.writeline('else:')
-                stream.indent()
-                self.compile_statement(statement.false, stream)
-                stream.dedent()
+                self.compile_block(false, stream)
 
             return
 
         if isinstance(statement, ast.Assign):
-            stream.writeline(self.compile_assignment(statement.node, self.compile_expression(statement.expr)))
+            self.compile_store(statement.node, self.compile_expression(statement.expr), stream)
             return
 
         if isinstance(statement, ast.FuncDecl):
             if statement.node:
-                stream.writeline(self.compile_assignment(statement.node, self.compile_function(statement)))
+                self.compile_store(statement.node, self.compile_function(statement), stream)
                 return
 
+        if isinstance(statement, (ast.While, ast.ForIn)):
+            self.compile_loop(statement, stream)
+            return
+
         if isinstance(statement, ast.LabelledStatement):
             assert isinstance(statement.identifier, ast.Identifier)
-            
-            assert statement.identifier.name not in self.labels
 
-            self.labels.add(statement.identifier.name)
+            labels = [statement.identifier.name]
+            body = statement.statement
+
+            if isinstance(body, list) and len(body) == 1:
+                body = body[0]
+
+            if isinstance(body, (ast.While, ast.ForIn)):
+                self.compile_loop(body, stream, labels)
+                return
 
-            label_name = self.compile_statements(statement.statement, label=statement.identifier.name)
-            
-            stream.writeline('label = %s(this, scope)' % label_name)
-            stream.writeline('if not (isinstance(label, Label) and label in [%r, '']):' % (statement.identifier.name))
+            # Labelled block is a loop which runs once
+            self.open_target(stream, labels)
+
+            stream.writeline('while True:')
             stream.indent()
-            
-            if not program:
-                stream.writeline('return label')
-            else:
-                stream.writeline('assert False')
-            
+            self.compile_statement(statement.statement, stream)
+            stream.writeline('break')
             stream.dedent()
 
-            self.labels.remove(statement.identifier.name)
-            
+            self.close_target(stream)
+
             return
 
         if isinstance(statement, ast.Break):
-            if isinstance(statement.identifier, ast.Identifier):
-                assert statement.identifier.name in self.labels
-                stream.writeline('return Label(%r)' % statement.identifier.name)
-            else:
-                stream.writeline('return Label()')
+            self.compile_jump('break', statement.identifier, stream)
+            return
+
+        if isinstance(statement, ast.Continue):
+            self.compile_jump('continue', statement.identifier, stream)
             return
 
         # assert, for testing
@@ -402,42 +1275,38 @@ class Compiler(object):
         if isinstance(statement, ast.Return):
             stream.writeline('return %s' % self.compile_expression(statement.expression))
             return
-        
+
         if isinstance(statement, ast.Switch):
-            switch_name = self.generate_name('switch')
-            switch_stream = self.stream.child()
-            self.functions.append(switch_stream)
-            switch_stream.writeline('def %s(this,scope):' % switch_name)
-            switch_stream.indent()
+            if all(self.literal(case.identifier)[0] for case in statement.cases):
+                self.compile_table_switch(statement, stream)
+                return
 
-            expr = self.compile_expression(statement.expression)
             name = self.generate_name('value')
-            switch_stream.writeline('%s = %s' % (name, expr))
-            true_name = self.generate_name('true')
-            switch_stream.writeline('%s = False' % true_name)
-            
-            for case in statement.cases:
-                switch_stream.writeline('if %s == %s:' % (name, self.compile_expression(case.identifier)))
-                switch_stream.indent()
-                switch_stream.writeline('%s = True' % true_name)
-                switch_stream.dedent()
-                
-                switch_stream.writeline('if %s:' % true_name)
-                switch_stream.indent()
-                self.compile_statements(case.statements, switch_stream)
-                switch_stream.dedent()
+            stream.writeline('%s = %s' % (name, self.compile_expression(statement.expression)))
+            matched = self.generate_name('matched')
+            stream.writeline('%s = False' % matched)
 
-            if statement.default:
-                self.compile_statements(statement.default.statements, switch_stream)
+            # Switch is a loop which runs once, so break leaves it
+            self.open_target(stream, switch=True)
 
-            stream.writeline('label = %s(this, scope)' % switch_name)
+            stream.writeline('while True:')
+            stream.indent()
 
-            if not program:
-                stream.writeline('if not(isinstance(label, Label) and label == ""):')
+            for case in statement.cases:
+                stream.writeline('if %s or %s == %s:' % (matched, name, self.compile_expression(case.identifier)))
                 stream.indent()
-                stream.writeline('return label')
+                stream.writeline('%s = True' % matched)
+                self.compile_statements(case.statements, stream)
                 stream.dedent()
 
+            if statement.default:
+                self.compile_statements(statement.default.statements, stream)
+
+            stream.writeline('break')
+            stream.dedent()
+
+            self.close_target(stream)
+
             return
 
         if isinstance(statement, ast.Throw):
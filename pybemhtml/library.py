@@ -1,9 +1,14 @@
 # Javascript objects
 
+from collections import OrderedDict
+from itertools import izip
 import logging
+import Queue
 import random
 import re
-import simplejson
+import sys
+import threading
+from time import time
 
 
 log = logging.getLogger('pybemhtml.library')
@@ -26,8 +31,8 @@ class JavascriptException(Exception):
 
 
 class Scope(object):
-    def __init__(self, parent=None):
-        self.variables = {}
+    def __init__(self, parent=None, variables=None):
+        self.variables = {} if variables is None else variables
         self.parent = parent
         super(Scope, self).__init__()
 
@@ -71,39 +76,203 @@ class Scope(object):
         return newvalue
 
 
-def getproperty(object, property):
+class RenderState(threading.local):
+    context = None
+    list_properties = None
+
+
+render_state = RenderState()
+
+
+class RenderContext(object):
+    # Isolates global variables for the duration of a render. While a context
+    # is active in a thread, templates read and write globals through an
+    # overlay of their own, the module scope itself is only read.
+    def __init__(self):
+        self.overlays = {}
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = render_state.context
+        render_state.context = self
+
+        return self
+
+    def __exit__(self, *exc_info):
+        render_state.context = self.previous
+        self.previous = None
+
+
+class GlobalScope(Scope):
+    # Top level scope of a compiled module, its parent holds the builtins
+    def __init__(self, parent=None, variables=None):
+        Scope.__init__(self, builtins if parent is None else parent, variables)
+
+    def __getitem__(self, item):
+        context = render_state.context
+
+        if context is not None:
+            overlay = context.overlays.get(self)
+
+            if overlay is not None and item in overlay:
+                return overlay[item]
+
+        try:
+            return self.variables[item]
+        except KeyError:
+            try:
+                return self.parent[item]
+            except KeyError:
+                pass
+
+        raise ReferenceError('%s is not defined' % item)
+
+    def __setitem__(self, item, value):
+        context = render_state.context
+
+        if context is None:
+            self.variables[item] = value
+        else:
+            context.overlays.setdefault(self, {})[item] = value
+
+        return value
+
+    var = __setitem__
+
+
+# Variables resolved by the compiler are accessed directly in scope dicts
+
+def setvariable(variables, item, value):
+    variables[item] = value
+    return value
+
+
+def updatevariable(variables, item, function, postfix):
+    value = variables[item]
+    newvalue = function(value)
+    variables[item] = newvalue
+
+    if postfix:
+        return value
+
+    return newvalue
+
+
+# Property access is dispatched on the exact type of the object. Handlers are
+# looked up with isinstance checks once per type and memoized in these tables
+
+property_getters = {}
+property_setters = {}
+
+
+def getstringproperty(object, property):
+    return Object.getproperty(String.prototype, property)
+
+
+def getobjectproperty(object, property):
+    return object[property]
+
+
+def setitemproperty(object, property, value):
+    object[property] = value
+    return value
+
+
+def setarrayproperty(object, property, value):
+    Array.setproperty(object, property, value)
+    return value
+
+
+def find_property_getter(object):
     if isinstance(object, dict):
-        return Object.getproperty(object, property)
+        return Object.getproperty
 
     if isinstance(object, unicode):
-        return Object.getproperty(String.prototype, property)
+        return getstringproperty
+
+    if isinstance(object, OutputSink):
+        return getsinkproperty
 
     if isinstance(object, list):
-        return Array.getproperty(object, property)
+        return Array.getproperty
 
     if isinstance(object, Object):
-        return object[property]
+        return getobjectproperty
 
     if hasattr(object, '__call__'):
-        return PythonFunction.getproperty(object, property)
+        return PythonFunction.getproperty
 
-    raise InternalError('Unknown object type %r', object)
+    return None
 
 
-def setproperty(object, property, value):
+def find_property_setter(object):
     if isinstance(object, dict):
-        object[property] = value
-        return value
+        return setitemproperty
+
+    if isinstance(object, OutputSink):
+        return setsinkproperty
 
     if isinstance(object, list):
-        Array.setproperty(object, property, value)
-        return value
+        return setarrayproperty
 
     if isinstance(object, Object):
-        object[property] = value
-        return value
-    
-    raise InternalError('Unknown object type %r', object)
+        return setitemproperty
+
+    return None
+
+
+def getproperty(object, property):
+    try:
+        getter = property_getters[type(object)]
+    except KeyError:
+        getter = find_property_getter(object)
+
+        if getter is None:
+            raise InternalError('Unknown object type %r', object)
+
+        property_getters[type(object)] = getter
+
+    return getter(object, property)
+
+
+def getnamedproperty(object, name):
+    # Fast path for constant property names, which are always strings
+    cls = type(object)
+
+    if cls is dict:
+        try:
+            return object[name]
+        except KeyError:
+            pass
+    elif cls is Object:
+        try:
+            return object.properties[name]
+        except KeyError:
+            pass
+    elif isinstance(object, JavascriptArray):
+        if not name.isdigit() and name != 'length':
+            properties = getattr(object, 'properties', None)
+
+            if properties and name in properties:
+                return properties[name]
+
+            return getproperty(Array.prototype, name)
+
+    return getproperty(object, name)
+
+
+def setproperty(object, property, value):
+    try:
+        setter = property_setters[type(object)]
+    except KeyError:
+        setter = find_property_setter(object)
+
+        if setter is None:
+            raise InternalError('Unknown object type %r', object)
+
+        property_setters[type(object)] = setter
+
+    return setter(object, property, value)
 
 
 def updateproperty(object, property, function, postfix, *args):
@@ -149,15 +318,6 @@ def enumerate_properties(object):
     raise InternalError("Don't know how to enumerate %r" % object)
 
 
-def forinloop(this, scope, item, iterator, statement):
-    for value in enumerate_properties(iterator):
-        scope.var(item, value)
-        
-        statement(this, scope)
-
-    return undefined
-
-
 def new(objectType, parameters):
     if getattr(objectType, 'constructor'):
         return objectType(None, parameters)
@@ -197,13 +357,6 @@ def typeof(value):
     raise InternalError("Unknown object %r" % value)
 
 
-def whileloop(this, scope, condition, statement):
-    while condition(scope):
-        statement(this, scope)
-
-    return undefined
-
-
 class Base(object):
     pass
 
@@ -337,8 +490,11 @@ class Object(Base):
 
     @classmethod
     def getproperty(cls, this, property):
+        if not isinstance(property, basestring):
+            property = unicode(property)
+
         try:
-            return this[unicode(property)]
+            return this[property]
         except KeyError:
             pass
 
@@ -377,9 +533,183 @@ class Number(Object):
         return NaN
 
 
-class Array(Object):
-    extraproperties = {}
+class JavascriptArray(list):
+    # Array value, carries its own non-index properties
+    __slots__ = ('properties',)
+
+
+def list_properties(this, create=False):
+    # Named properties of plain python lists, which hosts pass in as BEMJSON.
+    # They are kept by the outermost javascript call of the thread and dropped
+    # when it returns. Entries hold on to their list, so its id can not be
+    # reused while they exist.
+    table = render_state.list_properties
+
+    if table is None:
+        if create:
+            raise InternalError("Can't set property of %r outside of a javascript call" % this)
+
+        return None
+
+    entry = table.get(id(this))
+
+    if entry is not None:
+        return entry[1]
+
+    if not create:
+        return None
+
+    properties = {}
+    table[id(this)] = (this, properties)
+
+    return properties
+
+
+class OutputSink(JavascriptArray):
+    # Buffer whose items are passed on to write in chunks of at least
+    # chunk_size characters, join flushes the rest and returns an empty string.
+    # Items are written joined by separator, a join with another separator is
+    # only possible while nothing was written yet.
+    __slots__ = ('write', 'chunk_size', 'size', 'separator', 'flushed')
+
+    def __init__(self, write, chunk_size=8192, separator=u''):
+        JavascriptArray.__init__(self)
+
+        self.write = write
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.separator = separator
+        self.flushed = 0
+
+    def extend(self, items):
+        for item in items:
+            if item.__class__ is not unicode and not isinstance(item, basestring):
+                item = unicode(item)
+
+            self.append(item)
+            self.size += len(item)
+
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def join(self, separator):
+        if separator != self.separator:
+            if self.flushed:
+                raise InternalError("Output was already written with separator %r" % self.separator)
+
+            self.separator = separator
+
+        self.flush()
+
+        return u''
+
+    def flush(self):
+        if self:
+            chunk = self.separator.join(self)
+
+            if self.flushed:
+                chunk = self.separator + chunk
+
+            self.write(chunk)
+
+            self.flushed += len(self)
+            del self[:]
+            self.size = 0
+
+
+def getsinkproperty(sink, property):
+    # Indexes and length count the items already written, which can not be
+    # read back
+    if property == 'length':
+        return sink.flushed + len(sink)
+
+    index = Array.coerceindex(property)
+
+    if index is not None:
+        if index < sink.flushed:
+            raise InternalError("Item %d of the output was already written" % index)
+
+        index -= sink.flushed
+
+    return Array.getproperty(sink, property if index is None else index)
+
+
+def setsinkproperty(sink, property, value):
+    if sink.flushed and (property == 'length' or Array.coerceindex(property) is not None):
+        raise InternalError("Can't set %r of an output that was already written" % property)
+
+    return setarrayproperty(sink, property, value)
+
 
+class RenderAborted(Exception):
+    pass
+
+
+class StreamingOutput(object):
+    # WSGI iterable, runs render(sink) in a background thread and yields the
+    # output as the sink flushes it. A string returned by render is sent last.
+    CHUNK, DONE, ERROR = range(3)
+
+    def __init__(self, render, chunk_size=8192, queue_size=16, encoding='utf-8'):
+        self.render = render
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.queue = Queue.Queue(queue_size)
+        self.closed = False
+        self.thread = None
+
+    def run(self):
+        try:
+            sink = OutputSink(self.put, self.chunk_size)
+
+            with RenderContext():
+                result = self.render(sink)
+
+            sink.flush()
+
+            if isinstance(result, basestring) and result:
+                self.put(result)
+        except RenderAborted:
+            return
+        except Exception:
+            self.queue.put((self.ERROR, sys.exc_info()))
+        else:
+            self.queue.put((self.DONE, None))
+
+    def put(self, chunk):
+        if self.closed:
+            raise RenderAborted()
+
+        self.queue.put((self.CHUNK, chunk))
+
+    def __iter__(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+        while True:
+            kind, value = self.queue.get()
+
+            if kind == self.CHUNK:
+                yield value.encode(self.encoding)
+            elif kind == self.ERROR:
+                raise value[0], value[1], value[2]
+            else:
+                return
+
+    def close(self):
+        self.closed = True
+
+        # Unblock the renderer, its next write aborts the render
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+
+class Array(Object):
     def __new__(cls, *args, **kwargs):
         raise InternalError("Array object should not be instantiated")
 
@@ -403,9 +733,9 @@ class Array(Object):
                 if length < 0:
                     raise RangeError('invalid array length')
 
-                return [undefined] * length
+                return JavascriptArray([undefined] * length)
 
-        return arguments
+        return JavascriptArray(arguments)
 
     @javascript
     def push(this, arguments):
@@ -417,13 +747,21 @@ class Array(Object):
             
     @javascript
     def join(this, arguments):
-        return arguments[0].join(unicode(arg) for arg in this)
+        if isinstance(this, OutputSink):
+            return this.join(arguments[0])
+
+        try:
+            return arguments[0].join(this)
+        except TypeError:
+            return arguments[0].join(unicode(arg) for arg in this)
 
     @javascript
     def unshift(this, arguments):
         this[0:0] = arguments
         return len(this)
 
+    INDEX = re.compile(r'[0-9]+\Z')
+
     @classmethod
     def coerceindex(cls, property):
         if isinstance(property, int):
@@ -439,10 +777,11 @@ class Array(Object):
                 return None
 
         if isinstance(property, basestring):
-            try:
-                index = int(property, 10)
-            except ValueError:
+            # Ascii digits only, int does not parse other unicode digits
+            if not cls.INDEX.match(property):
                 return None
+
+            index = int(property, 10)
             
         if index < 0:
             return None
@@ -462,10 +801,16 @@ class Array(Object):
             except IndexError:
                 pass
 
-        try:
-            return cls.extraproperties[id(this)][unicode(property)]
-        except KeyError:
-            pass
+        if isinstance(this, JavascriptArray):
+            properties = getattr(this, 'properties', None)
+        else:
+            properties = list_properties(this)
+
+        if properties:
+            try:
+                return properties[unicode(property)]
+            except KeyError:
+                pass
 
         return getproperty(cls.prototype, property)
 
@@ -490,7 +835,17 @@ class Array(Object):
                 
             this[index] = value
 
-        cls.extraproperties.setdefault(id(this), {})[unicode(property)] = value
+            return value
+
+        if isinstance(this, JavascriptArray):
+            try:
+                properties = this.properties
+            except AttributeError:
+                properties = this.properties = {}
+        else:
+            properties = list_properties(this, create=True)
+
+        properties[unicode(property)] = value
 
         return value
 
@@ -500,7 +855,7 @@ class Boolean(Object):
 
 
 class Function(Object):
-    def __init__(self, code=None, parameters=[], scope=None, name='function'):
+    def __init__(self, code=None, parameters=[], scope=None, name='function', declarations=(), arguments=True):
         Object.__init__(self)
 
         self.name = name
@@ -508,6 +863,14 @@ class Function(Object):
         self.parameters = parameters
         self.scope = scope or Scope()
 
+        # Declared variables are hoisted to the top of the function, missing
+        # parameters are undefined
+        self.hoisted = dict.fromkeys(declarations, undefined)
+        self.hoisted.update(dict.fromkeys(parameters, undefined))
+
+        # The compiler clears this for functions which never reference arguments
+        self.arguments = arguments
+
         self['length'] = Number(len(parameters))
         self['prototype'] = {}
 
@@ -544,24 +907,82 @@ class Function(Object):
         return this(instance, arguments)
 
     def __call__(self, this, arguments):
-        scope = Scope(self.scope)
+        variables = self.hoisted.copy()
+        variables.update(izip(self.parameters, arguments))
 
-        scope.var('arguments', arguments)
+        if self.arguments:
+            arguments = JavascriptArray(arguments)
+            arguments.properties = {u'callee': self}
 
-        setproperty(arguments, 'callee', self)
+            variables['arguments'] = arguments
 
-        for i, p in enumerate(self.parameters):
-            try:
-                scope.var(p, arguments[i])
-            except IndexError:
-                scope.var(p, undefined)
+        if render_state.list_properties is not None:
+            return self.code(this, Scope(self.scope, variables))
 
-        return self.code(this, scope)
+        # Outermost call of the thread
+        render_state.list_properties = {}
+
+        try:
+            return self.code(this, Scope(self.scope, variables))
+        finally:
+            render_state.list_properties = None
 
     def __repr__(self):
         return "%s()" % self.name
 
 
+# Calls and cumulative time of instrumented functions in this process, keyed
+# by function name, block and mode. Updates are not locked, concurrent renders
+# may occasionally lose a count.
+function_stats = {}
+
+
+def context_key(this, name):
+    if type(this) is dict:
+        value = this.get(name)
+    elif isinstance(this, Object):
+        value = this.properties.get(name)
+    else:
+        return None
+
+    if isinstance(value, basestring):
+        return value
+
+    return None
+
+
+class InstrumentedFunction(Function):
+    # Function of a module compiled with instrumentation
+    def __call__(self, this, arguments):
+        key = self.name, context_key(this, u'block'), context_key(this, u'_mode')
+
+        start = time()
+
+        try:
+            return Function.__call__(self, this, arguments)
+        finally:
+            elapsed = time() - start
+
+            try:
+                stats = function_stats[key]
+            except KeyError:
+                stats = function_stats.setdefault(key, [0, 0.0])
+
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def stats_snapshot():
+    # List of (name, block, mode, calls, seconds), most expensive first
+    snapshot = [key + tuple(stats) for key, stats in function_stats.items()]
+
+    return sorted(snapshot, key=lambda entry: entry[4], reverse=True)
+
+
+def reset_stats():
+    function_stats.clear()
+
+
 class PythonFunction(Function):
     def __init__(self, callable=None):
         Object.__init__(self)
@@ -586,6 +1007,21 @@ class PythonFunction(Function):
         raise InternalError()
 
 
+def escape_string(value, replacements):
+    # Global replacements of literal strings in order, compiled from chains of
+    # value.replace(new RegExp("&", "g"), "&amp;") calls
+    if isinstance(value, basestring):
+        for old, new in replacements:
+            value = value.replace(old, new)
+
+        return value
+
+    for old, new in replacements:
+        value = getnamedproperty(value, u'replace')(value, [RegExp(re.escape(old), u'g'), new])
+
+    return value
+
+
 class String(Object):
     @javascript
     def replace(this, arguments):
@@ -596,9 +1032,12 @@ class String(Object):
             def replacement_function(match):
                 arguments = [match.group()] + list(match.groups()) + [match.start(), this]
                 return replacement(undefined, arguments)
+        else:
+            # Backslashes are plain characters in javascript replacement strings
+            replacement_function = unicode(replacement).replace('\\', '\\\\')
 
         if isinstance(pattern, RegExp):
-            return pattern.replace(this, replacement_function or replacement)
+            return pattern.replace(this, replacement_function)
 
         raise InternalError('unsupported object for pattern %r' % pattern)
    
@@ -607,10 +1046,34 @@ class String(Object):
         return this[arguments[0]:arguments[1]]
 
 
+# Compiled patterns of dynamically built regular expressions, least recently
+# used ones are dropped first
+regexp_cache = OrderedDict()
+regexp_cache_size = 256
+regexp_lock = threading.Lock()
+
+
+def compile_regexp(pattern, flags):
+    key = pattern, flags
+
+    with regexp_lock:
+        try:
+            compiled = regexp_cache.pop(key)
+        except KeyError:
+            compiled = re.compile(pattern, flags)
+
+            if len(regexp_cache) >= regexp_cache_size:
+                regexp_cache.popitem(last=False)
+
+        regexp_cache[key] = compiled
+
+    return compiled
+
+
 class RegExp(Object):
-    FLAGS = re.compile("[gi]*")
+    FLAGS = re.compile("[gi]*$")
     
-    def __init__(self, pattern, flags):
+    def __init__(self, pattern, flags=''):
         Object.__init__(self)
         
         re_flags = 0
@@ -623,11 +1086,11 @@ class RegExp(Object):
 
         self.all = 'g' in flags
 
-        self.re = re.compile(unicode(pattern), re_flags)
+        self.re = compile_regexp(unicode(pattern), re_flags)
 
     @staticmethod
     def new(this, arguments):
-        return RegExp(arguments[0], arguments[1])
+        return RegExp(*arguments[:2])
 
     def replace(self, string, replacement):
         count = 0 if self.all else 1
@@ -644,14 +1107,101 @@ class Math(Object):
         return random.random()
 
 
+class JSONFallback(Exception):
+    pass
+
+
+def json_default(value):
+    # Called by the encoder for runtime types it does not know. Values which
+    # are omitted or replaced depending on where they appear fall back to
+    # converting the whole value with json_value.
+    if isinstance(value, Number):
+        if value.number is Number.NaN:
+            return None
+
+        return value.number
+
+    if value is undefined or isinstance(value, Function):
+        raise JSONFallback()
+
+    if isinstance(value, Object):
+        return value.properties
+
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def json_value(value):
+    # Plain data with javascript semantics: undefined and functions are left
+    # out of objects and become null in arrays, non-finite numbers are null
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            return None
+
+        return value
+
+    if isinstance(value, dict):
+        return dict((key, json_value(item)) for key, item in value.iteritems()
+                    if item is not undefined and not isinstance(item, Function))
+
+    if isinstance(value, list):
+        return [None if item is undefined or isinstance(item, Function) else json_value(item) for item in value]
+
+    if isinstance(value, Number):
+        return None if value.number is Number.NaN else json_value(value.number)
+
+    if isinstance(value, Object):
+        return json_value(value.properties)
+
+    return value
+
+
+json_encoder = None
+
+
+def get_json_encoder():
+    # The JSON module is imported on first use, most templates never call
+    # JSON.stringify and workers should start fast
+    global json_encoder
+
+    if json_encoder is None:
+        try:
+            import simplejson as json
+        except ImportError:
+            import json
+
+        # NaN is not allowed so that the encoder raises instead of writing
+        # it out, json_value turns it into null
+        json_encoder = json.JSONEncoder(separators=(',', ':'), allow_nan=False, default=json_default)
+
+    return json_encoder
+
+
+def stringify(value):
+    if value is undefined or isinstance(value, Function):
+        return undefined
+
+    encoder = get_json_encoder()
+
+    try:
+        return encoder.encode(value)
+    except (JSONFallback, ValueError):
+        return encoder.encode(json_value(value))
+
+
+def stringify_into(value, buffer):
+    # Pushes the JSON of value into an array or output sink
+    result = stringify(value)
+
+    if result is not undefined:
+        buffer.extend((result,))
+
+    return result
+
+
 class JSON(Object):
     @javascript
     def stringify(this, arguments):
-        return simplejson.dumps(arguments[0], separators=(',',':'))
-
-
-class Label(unicode):
-    pass
+        return stringify(arguments[0] if arguments else undefined)
 
 
 Object.prototype = Object.properties
@@ -667,12 +1217,11 @@ Function.prototype.prototype = None
 NaN = Number(Number.NaN)
 
 def console_log(this, arguments):
-    import logging
     log.debug(" ".join(repr(arg) for arg in arguments))
 
 console = {'log': PythonFunction(console_log)}
 
-scope = Scope({
+builtins = {
     'Array': PythonFunction(Array),
     'Boolean': PythonFunction(Boolean),
     'Function': PythonFunction(Function),
@@ -683,6 +1232,9 @@ scope = Scope({
     'Math': Math.properties,
     'JSON': JSON.properties,
     'console': console,
-})
+}
+
+# Shared scope of modules compiled before they got a GlobalScope of their own
+scope = Scope(builtins)
 
 this = undefined
@@ -0,0 +1,41 @@
+# Loading of generated code, usable without the compiler and its parser
+
+import imp
+import itertools
+
+
+# Bump whenever generated code changes, so cached output gets invalidated
+VERSION = 15
+
+
+def signature(optimize=True, instrument=False):
+    return 'pybemhtml-%s%s%s' % (VERSION, '-O' if optimize else '', '-I' if instrument else '')
+
+
+module_counter = itertools.count()
+
+
+def compile_code(source, filename=None):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+
+    return compile(source, filename or '<pybemhtml>', 'exec')
+
+
+def load_module(code, name=None):
+    # Executes generated code into a fresh module, bypassing the import system
+    if isinstance(code, basestring):
+        code = compile_code(code)
+
+    if name is None:
+        name = 'pybemhtml_module_%d' % next(module_counter)
+
+    module = imp.new_module(name)
+
+    # Python clears the globals of a module when it is deallocated, keep the
+    # module alive for as long as its functions are reachable
+    module.__dict__['__pybemhtml_module__'] = module
+
+    exec code in module.__dict__
+
+    return module
@@ -0,0 +1,51 @@
+# Pool of forked worker processes sharing templates loaded in the parent
+
+import itertools
+import multiprocessing
+
+from pybemhtml.library import RenderContext, undefined
+
+
+# Workers are forked with a copy of this registry, so compiled templates never
+# have to be pickled or loaded again in the children
+renderers = {}
+pool_counter = itertools.count()
+
+
+def render_task(task):
+    key, bemjson = task
+
+    with RenderContext():
+        return renderers[key](undefined, [bemjson])
+
+
+class RenderPool(object):
+    def __init__(self, render, processes=None):
+        self.key = next(pool_counter)
+
+        renderers[self.key] = render
+
+        self.pool = multiprocessing.Pool(processes)
+
+    def render(self, bemjson_list, chunksize=None):
+        tasks = [(self.key, bemjson) for bemjson in bemjson_list]
+
+        return self.pool.map(render_task, tasks, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+        renderers.pop(self.key, None)
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+        renderers.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,139 @@
+# Registry of compiled templates, reloaded in the background when their
+# sources change
+
+import hashlib
+import logging
+import os
+import threading
+
+from pybemhtml.loader import load_module
+
+
+log = logging.getLogger('pybemhtml.registry')
+
+
+class Template(object):
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.digest = None
+        self.module = None
+
+
+# Modules are replaced with a single assignment once the new version is fully
+# loaded, renders holding the old module or its functions finish on it
+class TemplateRegistry(object):
+    def __init__(self, interval=1.0, cache=None, compiler=None):
+        self.interval = interval
+        self.cache = cache
+        self._compiler = compiler
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.compile_lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def compiler(self):
+        if self._compiler is None:
+            from pybemhtml.compiler import Compiler
+
+            self._compiler = Compiler()
+
+        return self._compiler
+
+    def add(self, name, path):
+        template = Template(path)
+
+        self.reload(template, raise_errors=True)
+
+        with self.lock:
+            self.templates[name] = template
+
+        return template.module
+
+    def remove(self, name):
+        with self.lock:
+            del self.templates[name]
+
+    def get(self, name):
+        return self.templates[name].module
+
+    __getitem__ = get
+
+    def stat(self, path):
+        stat = os.stat(path)
+
+        return stat.st_mtime, stat.st_size
+
+    def load(self, js):
+        # The compiler keeps the state of a compile on itself, so compiles
+        # for add() and the polling thread take turns
+        with self.compile_lock:
+            if self.cache is not None:
+                return self.cache.load_module(js)
+
+            return load_module(self.compiler.compile(js))
+
+    def reload(self, template, raise_errors=False):
+        # Returns whether a new module was swapped in
+        stat = None
+
+        try:
+            stat = self.stat(template.path)
+
+            if stat == template.stat:
+                return False
+
+            js = open(template.path, 'rb').read()
+            digest = hashlib.sha1(js).hexdigest()
+
+            if digest == template.digest:
+                template.stat = stat
+                return False
+
+            module = self.load(js.decode('utf-8'))
+        except Exception:
+            if raise_errors:
+                raise
+
+            log.exception('Failed to reload %s', template.path)
+
+            # Retried only once the file changes again
+            if stat is not None:
+                template.stat = stat
+
+            return False
+
+        template.module = module
+        template.stat = stat
+        template.digest = digest
+
+        log.info('Reloaded %s', template.path)
+
+        return True
+
+    def check(self):
+        # One polling pass, returns names of the reloaded templates
+        with self.lock:
+            templates = self.templates.items()
+
+        return [name for name, template in templates if self.reload(template)]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+
+            self.thread = threading.Thread(target=self.run, name='pybemhtml-registry')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
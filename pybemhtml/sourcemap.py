@@ -0,0 +1,74 @@
+# Mapping of generated code back to the javascript source
+
+import bisect
+import pstats
+
+
+class SourceMap(object):
+    # functions maps generated function names to the javascript function name,
+    # line and column, lines maps generated lines to javascript lines and
+    # columns. Positions are None when the parser does not provide them,
+    # which is the case for pyjsparser: lines stays empty and only the
+    # function names are mapped.
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.functions = {}
+        self.lines = {}
+        self._keys = None
+
+    def function(self, name):
+        return self.functions.get(name)
+
+    def lookup(self, line):
+        # Position of the statement the generated line belongs to
+        if self._keys is None or len(self._keys) != len(self.lines):
+            self._keys = sorted(self.lines)
+
+        index = bisect.bisect_right(self._keys, line)
+
+        if not index:
+            return None
+
+        return self.lines[self._keys[index - 1]]
+
+
+def rewrite_stats(stats, source_map, filename):
+    # Renames pstats entries of the generated module filename after the
+    # javascript functions they were compiled from
+    def rewrite(key):
+        path, line, name = key
+
+        if path != filename:
+            return key
+
+        function = source_map.function(name)
+
+        if function is None:
+            return key
+
+        js_name, js_line, column = function
+
+        if js_line is None:
+            position = source_map.lookup(line)
+            js_line = position[0] if position else 0
+
+        return source_map.filename or path, js_line, js_name
+
+    rewritten = {}
+
+    for key, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        callers = dict((rewrite(caller), value) for caller, value in callers.iteritems())
+        key = rewrite(key)
+
+        if key in rewritten:
+            rewritten[key] = pstats.add_func_stats(rewritten[key], (cc, nc, tt, ct, callers))
+        else:
+            rewritten[key] = cc, nc, tt, ct, callers
+
+    stats.stats = rewritten
+    stats.top_level = set(rewrite(key) for key in stats.top_level)
+    stats.fcn_list = 0
+    stats.all_callees = None
+
+    return stats
+
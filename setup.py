@@ -19,6 +19,11 @@ setup(
     url='https://github.com/nullie/pybemhtml',
     packages=['pybemhtml'],
     zip_safe=False,
+    entry_points={
+        'console_scripts': [
+            'pybemhtml-compile = pybemhtml.cli:main',
+        ],
+    },
     include_package_data=True,
     test_suite = 'nose.collector',
     setup_requires=[
@@ -26,8 +31,10 @@ setup(
     ],
     install_requires=[
         "pyjsparser>=0.1",
-        "simplejson>=2.1",
     ],
+    extras_require={
+        "simplejson": ["simplejson>=2.1"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "License :: OSI Approved :: BSD License",
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from pybemhtml.cache import CompilerCache
+from pybemhtml.compiler import Compiler
+
+
+def test_cache():
+    source = u"""
+    i = 0
+    i++;
+    assert(i == 1);
+    """
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        cache = CompilerCache(directory)
+
+        python, code = cache.get(source)
+
+        assert python == Compiler().compile(source)
+
+        exec code in {}
+
+        class FailingCompiler(Compiler):
+            def compile(self, js):
+                raise AssertionError('cache miss')
+
+        warm = CompilerCache(directory, compiler=FailingCompiler())
+
+        assert warm.compile(source) == python
+
+        exec warm.compile_code(source) in {}
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_cache_eviction():
+    directory = tempfile.mkdtemp()
+
+    try:
+        cache = CompilerCache(directory)
+
+        cache.compile(u"i = 1;")
+
+        cache.max_size = cache.size()
+
+        cache.compile(u"i = 2;")
+
+        assert len(os.listdir(directory)) == 2
+        assert cache.key(u"i = 2;") + '.py' in os.listdir(directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_write_atomic():
+    from pybemhtml import cache
+
+    directory = tempfile.mkdtemp()
+    umask = os.umask(022)
+
+    try:
+        path = os.path.join(directory, 'templates.py')
+
+        cache.write_atomic(path, 'x = 1\n')
+
+        assert open(path).read() == 'x = 1\n'
+        assert os.stat(path).st_mode & 0777 == 0644
+
+        try:
+            cache.write_atomic(path, None)
+        except TypeError:
+            pass
+        else:
+            assert False, 'expected TypeError'
+
+        # A failed write leaves the previous file and no temporary behind
+        assert os.listdir(directory) == ['templates.py']
+        assert open(path).read() == 'x = 1\n'
+    finally:
+        os.umask(umask)
+        shutil.rmtree(directory)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+from pybemhtml.cli import compile_tree
+from pybemhtml.loader import load_module
+
+
+def test_compile_tree():
+    directory = tempfile.mkdtemp()
+
+    try:
+        source = os.path.join(directory, 'src')
+        output = os.path.join(directory, 'out')
+
+        os.makedirs(os.path.join(source, 'blocks'))
+
+        open(os.path.join(source, 'page.js'), 'w').write('function page() { return 1; }')
+        open(os.path.join(source, 'blocks', 'link.js'), 'w').write('function link() { return 2; }')
+        open(os.path.join(source, 'broken.js'), 'w').write('function (')
+        open(os.path.join(source, 'README'), 'w').write('')
+
+        statuses = lambda results: sorted((os.path.relpath(path, source), status) for path, status, error in results)
+
+        assert statuses(compile_tree(source, output, jobs=2)) == [
+            ('blocks/link.js', 'compiled'),
+            ('broken.js', 'failed'),
+            ('page.js', 'compiled'),
+        ]
+
+        module = load_module(open(os.path.join(output, 'blocks', 'link.py')).read())
+
+        assert module.scope['link'](None, []) == 2
+
+        open(os.path.join(source, 'page.js'), 'w').write('function page() { return 3; }')
+
+        assert statuses(compile_tree(source, output, jobs=1)) == [
+            ('blocks/link.js', 'skipped'),
+            ('broken.js', 'failed'),
+            ('page.js', 'compiled'),
+        ]
+
+        assert statuses(compile_tree(source, output, optimize=False)) == [
+            ('blocks/link.js', 'compiled'),
+            ('broken.js', 'failed'),
+            ('page.js', 'compiled'),
+        ]
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,308 @@
+from StringIO import StringIO
+
+from pybemhtml.compiler import Compiler
+
+
+def test_stream_output():
+    source = u"""
+    function f(a) {
+        switch (a) {
+            case 1:
+                return function() { return a; };
+        }
+    }
+    f(1);
+    """
+
+    output = StringIO()
+
+    assert Compiler().compile(source, output) is None
+    assert output.getvalue() == Compiler().compile(source)
+
+
+def test_lean_functions():
+    module = Compiler().compile_to_module(u"""
+    function lean(a, b) {
+        return b;
+    }
+
+    function full() {
+        return arguments.length;
+    }
+    """)
+
+    from pybemhtml.library import undefined
+
+    assert not module.scope['lean'].arguments
+    assert module.scope['lean'](undefined, [1]) is undefined
+    assert module.scope['full'].arguments
+    assert module.scope['full'](undefined, [1, 2]) == 2
+
+
+def test_optimizer_equivalence():
+    expressions = [
+        u"1 + 2 * 3",
+        u"'a' + 'b' + 1",
+        u"1 + 'a'",
+        u"2 - 3 - -1",
+        u"'x' + 1.5 + true",
+        u"1 + 'x' + (1.5 + 1)",
+        u"1 < 2 && 'yes' || 'no'",
+        u"0 || '' || 'last'",
+        u"!0 && !!'a'",
+        u"'a' == 'a' ? 'same' : 'other'",
+        u"true ? 1 + 1 : 0",
+        u"-1 + 1 === 0",
+    ]
+
+    source = u"\n".join(u"r%d = %s;" % (index, expression) for index, expression in enumerate(expressions)) + u"""
+    function branches(x) {
+        if (false) {
+            x = 'dead';
+        } else {
+            x = x + 1;
+        }
+
+        if (!!x) {
+            return x;
+        }
+
+        return 'unreachable';
+    }
+
+    r_branches = branches(1);
+    """
+
+    results = []
+
+    for optimize in [False, True]:
+        module = Compiler(optimize=optimize).compile_to_module(source)
+
+        results.append([module.scope['r%d' % index] for index in range(len(expressions))] + [module.scope['r_branches']])
+
+    assert results[0] == results[1]
+    assert [type(value) for value in results[0]] == [type(value) for value in results[1]]
+
+    # Folding must not turn an operand into a string the generated code would
+    # not coerce
+    for expression in [u"('' ? '' : '') + true", u"(true ? 'a' : 'b') + 1", u"('' || 'a') + false"]:
+        outcomes = []
+
+        for optimize in [False, True]:
+            try:
+                Compiler(optimize=optimize).compile_to_module(u"r = %s;" % expression)
+                outcomes.append('ok')
+            except TypeError:
+                outcomes.append('TypeError')
+
+        assert outcomes[0] == outcomes[1], expression
+
+
+def test_optimizer_output():
+    python = Compiler().compile(u"""
+    function f() {
+        if (false) {
+            g();
+        }
+
+        return 'a' + 'b' + 1;
+    }
+    """)
+
+    assert "u'ab1'" in python
+    assert 'g' not in python.split('def f0')[1].split('return')[0]
+    assert 'return undefined' not in python
+
+
+def test_source_map():
+    import cProfile
+    import pstats
+
+    from pybemhtml.library import undefined
+    from pybemhtml.sourcemap import rewrite_stats
+
+    module = Compiler().compile_to_module(u"""
+    function render(n) {
+        return [n].join('');
+    }
+    """, name='profiled', filename='templates.js')
+
+    render = module.scope['render']
+
+    profile = cProfile.Profile()
+    profile.runcall(render, undefined, [1])
+
+    stats = rewrite_stats(pstats.Stats(profile), module.__source_map__, '<profiled>')
+
+    assert [key for key in stats.stats if key[0] == 'templates.js' and key[2] == 'render']
+    assert not [key for key in stats.stats if key[0] == '<profiled>']
+
+    module = Compiler().compile_to_module(u"""
+    var a = function () { return 1; };
+    var b = function () { return 2; };
+    """, name='anonymous', filename='templates.js')
+
+    profile = cProfile.Profile()
+    profile.runcall(module.scope['a'], undefined, [])
+    profile.runcall(module.scope['b'], undefined, [])
+
+    stats = rewrite_stats(pstats.Stats(profile), module.__source_map__, '<anonymous>')
+    names = [key[2] for key in stats.stats if key[0] == 'templates.js']
+
+    # Anonymous functions are not merged into one entry
+    assert len(names) == 2
+    assert len(set(names)) == 2
+    assert all(name.startswith('function@') for name in names)
+
+
+def test_instrumentation():
+    from pybemhtml.library import undefined, reset_stats, stats_snapshot
+
+    source = u"""
+    function block(n) {
+        return n + 1;
+    }
+
+    function render(ctx) {
+        return block.call(ctx, 1) + block.call(ctx, 2);
+    }
+    """
+
+    reset_stats()
+
+    Compiler().compile_to_module(source).scope['render'](undefined, [{}])
+
+    assert stats_snapshot() == []
+
+    render = Compiler(instrument=True).compile_to_module(source).scope['render']
+
+    assert render(undefined, [{u'block': u'b-page', u'_mode': u'tag'}]) == 5
+
+    calls = dict((entry[:3], entry[3]) for entry in stats_snapshot())
+
+    assert calls == {
+        (u'render', None, None): 1,
+        (u'block', u'b-page', u'tag'): 2,
+    }
+
+    reset_stats()
+
+
+def test_regexp_hoisting():
+    from pybemhtml import library
+    from pybemhtml.library import undefined
+
+    source = u"""
+    function escape(s, flags) {
+        var amp = "&amp;";
+        return s.replace(new RegExp("&", "g"), amp).replace(new RegExp("<", flags), "&lt;");
+    }
+    """
+
+    python = Compiler().compile(source)
+
+    assert python.count('new(') == 1
+    assert "RegExp(u'&',u'g')" in python
+
+    escape = Compiler().compile_to_module(source).scope['escape']
+
+    assert escape(undefined, [u'<a&b<', u'g']) == u'&lt;a&amp;b&lt;'
+    assert escape(undefined, [u'<a&b<', u'']) == u'&lt;a&amp;b<'
+
+    size = library.regexp_cache_size
+
+    try:
+        library.regexp_cache_size = 2
+
+        for flags in (u'', u'g', u'i', u'gi'):
+            escape(undefined, [u'<', flags])
+
+        assert len(library.regexp_cache) == 2
+    finally:
+        library.regexp_cache_size = size
+
+
+def test_escape_chains():
+    from pybemhtml.library import undefined
+
+    source = u"""
+    function xmlEscape(str) {
+        return (str + '').replace(new RegExp('&', 'g'), '&amp;').replace(new RegExp('<', 'g'), '&lt;').replace(new RegExp('>', 'g'), '&gt;');
+    }
+
+    function firstOnly(str) {
+        return str.replace(new RegExp('&'), '&amp;');
+    }
+    """
+
+    python = Compiler().compile(source)
+
+    assert python.count('escape_string(') == 1
+
+    module = Compiler().compile_to_module(source)
+
+    assert module.scope['xmlEscape'](undefined, [u'<a & b>']) == u'&lt;a &amp; b&gt;'
+    assert module.scope['xmlEscape'](undefined, [1]) == u'1'
+    assert module.scope['firstOnly'](undefined, [u'&&']) == u'&amp;&'
+
+
+def test_this():
+    from pybemhtml.library import undefined
+
+    module = Compiler().compile_to_module(u"""
+    function block() {
+        return this.ctx.block + (this.elem ? '__' + this.elem : '');
+    }
+    """)
+
+    block = module.scope['block']
+
+    assert block({'ctx': {'block': u'b-link'}, 'elem': undefined}, []) == u'b-link'
+    assert block({'ctx': {'block': u'b-link'}, 'elem': u'inner'}, []) == u'b-link__inner'
+
+    # The parser may give this as a str or a unicode string
+    assert Compiler().compile_expression('this') == 'this'
+    assert Compiler().compile_expression(u'this') == 'this'
+
+
+def test_deep_nesting():
+    import sys
+
+    from pyjsparser.parser import Parser
+
+    from pybemhtml.library import undefined
+    from pybemhtml.loader import load_module
+
+    n = 500
+
+    source = u"""
+    function all(a) { return %s; }
+    function concat(a) { return "x"%s; }
+    function choose(a) { return %s-1; }
+    function branch(a) { if (a == -1) { return -1; } %s return -2; }
+    """ % (
+        ' && '.join(['a'] * n),
+        ' + a' * n,
+        ''.join(['a == %d ? %d : ' % (i, i) for i in xrange(n)]),
+        ' '.join(['else if (a == %d) { return %d; }' % (i, i) for i in xrange(n)]),
+    )
+
+    # Only the parser needs a deep python stack
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(20000)
+
+    try:
+        program = Parser().parse(source)
+    finally:
+        sys.setrecursionlimit(limit)
+
+    for optimize in (True, False):
+        module = load_module(Compiler(optimize=optimize).compile_program(program))
+
+        assert module.scope['all'](undefined, [1]) == 1
+        assert module.scope['all'](undefined, [0]) == 0
+        assert module.scope['concat'](undefined, [1]) == u'x' + u'1' * n
+        assert module.scope['choose'](undefined, [n - 1]) == n - 1
+        assert module.scope['choose'](undefined, [n]) == -1
+        assert module.scope['branch'](undefined, [n - 1]) == n - 1
+        assert module.scope['branch'](undefined, [n]) == -2
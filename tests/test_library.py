@@ -1,6 +1,5 @@
 import codecs
 import os.path
-import sys
 
 from pybemhtml.compiler import Compiler
 
@@ -9,13 +8,238 @@ def test_library():
 
     source = codecs.open(os.path.join(basedir, 'data', 'library.js'), encoding='utf-8').read()    
 
-    python = Compiler().compile(source)
+    scope = Compiler().compile_to_module(source).scope
 
-    codecs.open(os.path.join(basedir, 'tmp', 'library_js.py'), 'w', encoding='utf-8').write(python)
-
-    sys.path.append(os.path.join(basedir, 'tmp'))
-
-    from library_js import scope
     from pybemhtml.library import undefined, PythonFunction
 
     scope['tests'](undefined, [])
+
+
+def test_output_sink():
+    from pybemhtml.library import undefined, OutputSink, StreamingOutput
+
+    module = Compiler().compile_to_module(u"""
+    function render(items, buf) {
+        var i = 0;
+
+        while (i < items.length) {
+            buf.push('<li>', items[i], '</li>');
+            i++;
+        }
+
+        return buf.join('');
+    }
+    """)
+
+    render = module.scope['render']
+
+    chunks = []
+    sink = OutputSink(chunks.append, chunk_size=10)
+
+    assert render(undefined, [[1, 2, 3], sink]) == u''
+    assert len(chunks) == 3
+    assert u''.join(chunks) == u'<li>1</li><li>2</li><li>3</li>'
+
+    output = StreamingOutput(lambda sink: render(undefined, [range(100), sink]), chunk_size=64)
+
+    body = list(output)
+
+    assert len(body) > 1
+    assert ''.join(body) == ''.join('<li>%d</li>' % i for i in range(100))
+
+
+def test_output_sink_array():
+    from pybemhtml.library import undefined, InternalError, OutputSink
+
+    module = Compiler().compile_to_module(u"""
+    function csv(buf) {
+        buf.push('a', 'b');
+        return buf.join(',');
+    }
+
+    function fill(buf) {
+        buf.push('a', 'b');
+        buf.push('c');
+        return [buf.length, buf[2]];
+    }
+
+    function first(buf) {
+        return buf[0];
+    }
+    """)
+
+    chunks = []
+
+    assert module.scope['csv'](undefined, [OutputSink(chunks.append)]) == u''
+    assert chunks == [u'a,b']
+
+    # Separators are kept across chunks
+    chunks = []
+    sink = OutputSink(chunks.append, chunk_size=1, separator=u',')
+
+    module.scope['csv'](undefined, [sink])
+    module.scope['csv'](undefined, [sink])
+
+    assert u''.join(chunks) == u'a,b,a,b'
+
+    chunks = []
+    sink = OutputSink(chunks.append, chunk_size=2)
+
+    assert list(module.scope['fill'](undefined, [sink])) == [3, u'c']
+
+    try:
+        module.scope['first'](undefined, [sink])
+    except InternalError:
+        pass
+    else:
+        assert False, 'written items can not be read back'
+
+    try:
+        module.scope['csv'](undefined, [sink])
+    except InternalError:
+        pass
+    else:
+        assert False, 'the separator of written output can not change'
+
+
+def test_array_join():
+    from pybemhtml.library import undefined, JavascriptArray
+
+    module = Compiler().compile_to_module(u"""
+    function render(buf) {
+        buf.push('<b>', 1, '</b>');
+        return buf.join('');
+    }
+    """)
+
+    buf = JavascriptArray()
+
+    assert module.scope['render'](undefined, [buf]) == u'<b>1</b>'
+
+    # join leaves the items as they are
+    assert buf == [u'<b>', 1, u'</b>']
+
+
+
+def test_render_context():
+    import threading
+    from pybemhtml.library import undefined, RenderContext
+
+    module = Compiler().compile_to_module(u"""
+    var counter = 0;
+
+    function render(n) {
+        var i = 0;
+
+        while (i < n) {
+            counter++;
+            i++;
+        }
+
+        return counter;
+    }
+    """)
+
+    render = module.scope['render']
+    results = []
+
+    def worker(n):
+        with RenderContext():
+            results.append((n, render(undefined, [n])))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(1, 20)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [(n, n) for n in range(1, 20)]
+    assert module.scope['counter'] == 0
+
+    assert render(undefined, [2]) == 2
+    assert module.scope['counter'] == 2
+
+
+def test_json():
+    from pybemhtml.library import undefined, stringify_into, OutputSink
+
+    module = Compiler().compile_to_module(u"""
+    function encode(value) {
+        return JSON.stringify(value);
+    }
+
+    function f() {
+    }
+
+    var plain = encode({a: [1, 'b', true], c: {d: 'e'}});
+    var missing = encode({a: undefined, b: f, c: [undefined, f, 1]});
+    var nothing = encode(undefined);
+    """)
+
+    import json
+
+    assert json.loads(module.scope['plain']) == {u'a': [1, u'b', True], u'c': {u'd': u'e'}}
+    assert json.loads(module.scope['missing']) == {u'c': [None, None, 1]}
+    assert module.scope['nothing'] is undefined
+
+    encode = module.scope['encode']
+
+    assert encode(undefined, [float('nan')]) == 'null'
+
+    chunks = []
+    sink = OutputSink(chunks.append)
+
+    stringify_into({u'block': u'b-link'}, sink)
+    sink.flush()
+
+    assert chunks == [u'{"block":"b-link"}']
+
+
+def test_plain_list_properties():
+    import gc
+
+    from pybemhtml.library import undefined, render_state
+
+    module = Compiler().compile_to_module(u"""
+    function tag(ctx) {
+        ctx.content.seen = true;
+        return ctx.content.seen && ctx.content.length;
+    }
+
+    function render(items) {
+        var i = 0;
+
+        while (i < items.length) {
+            tag(items[i]);
+            i++;
+        }
+
+        return items.length;
+    }
+    """)
+
+    # BEMJSON from the host is made of plain lists
+    content = ['a', 'b']
+
+    assert module.scope['tag'](undefined, [{'content': content}]) == 2
+    assert content == ['a', 'b']
+
+    # Properties are dropped once the outermost call returns
+    assert render_state.list_properties is None
+
+    gc.collect()
+    objects = len(gc.get_objects())
+
+    for n in range(10):
+        items = [{'content': [i]} for i in range(100)]
+
+        assert module.scope['render'](undefined, [items]) == 100
+
+    del items
+    gc.collect()
+
+    assert render_state.list_properties is None
+    assert len(gc.get_objects()) <= objects + 10
+
@@ -0,0 +1,44 @@
+import gc
+import sys
+
+from pybemhtml.compiler import Compiler, load_module
+
+
+def test_compile_to_module():
+    source = u"""
+    function answer() {
+        return 42;
+    }
+    """
+
+    module = Compiler().compile_to_module(source)
+
+    from pybemhtml.library import undefined
+
+    assert module.scope['answer'](undefined, []) == 42
+    assert module.__name__ not in sys.modules
+
+    other = load_module(Compiler().compile(source))
+
+    assert other.__name__ != module.__name__
+
+
+def test_named_module():
+    module = Compiler().compile_to_module(u"i = 1;", name='templates')
+
+    assert module.__name__ == 'templates'
+    assert 'templates' not in sys.modules
+
+
+def test_unreferenced_module():
+    from pybemhtml.library import undefined
+
+    render = Compiler().compile_to_module(u"""
+    function render(x) {
+        return [x].join('');
+    }
+    """).scope['render']
+
+    gc.collect()
+
+    assert render(undefined, [u'a']) == u'a'
@@ -0,0 +1,16 @@
+from pybemhtml.compiler import Compiler
+from pybemhtml.library import undefined
+from pybemhtml.pool import RenderPool
+
+
+def test_render_pool():
+    render = Compiler().compile_to_module(u"""
+    function render(ctx) {
+        return ['<', ctx.tag, '>', ctx.content, '</', ctx.tag, '>'].join('');
+    }
+    """).scope['render']
+
+    bemjson = [{u'tag': u'b', u'content': unicode(i)} for i in range(20)]
+
+    with RenderPool(render, processes=2) as pool:
+        assert pool.render(bemjson) == [render(undefined, [ctx]) for ctx in bemjson]
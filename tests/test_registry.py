@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import time
+
+from pybemhtml.library import undefined
+from pybemhtml.registry import TemplateRegistry
+
+
+def write(path, source, mtime):
+    open(path, 'w').write(source)
+    os.utime(path, (mtime, mtime))
+
+
+def test_registry_reload():
+    directory = tempfile.mkdtemp()
+
+    try:
+        path = os.path.join(directory, 'page.js')
+        now = time.time()
+
+        write(path, 'function render() { return 1; }', now - 10)
+
+        registry = TemplateRegistry()
+        registry.add('page', path)
+
+        render = registry['page'].scope['render']
+
+        assert render(undefined, []) == 1
+        assert registry.check() == []
+
+        write(path, 'function render() { return 2; }', now - 5)
+
+        assert registry.check() == ['page']
+        assert registry['page'].scope['render'](undefined, []) == 2
+
+        # Renders holding the old version keep working
+        assert render(undefined, []) == 1
+
+        write(path, 'function render( {', now)
+
+        assert registry.check() == []
+        assert registry['page'].scope['render'](undefined, []) == 2
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_registry_thread():
+    directory = tempfile.mkdtemp()
+
+    try:
+        path = os.path.join(directory, 'page.js')
+
+        write(path, 'function render() { return 1; }', time.time() - 10)
+
+        registry = TemplateRegistry(interval=0.01)
+        registry.add('page', path)
+        registry.start()
+
+        try:
+            write(path, 'function render() { return 2; }', time.time())
+
+            deadline = time.time() + 5
+
+            while registry['page'].scope['render'](undefined, []) != 2 and time.time() < deadline:
+                time.sleep(0.01)
+
+            assert registry['page'].scope['render'](undefined, []) == 2
+        finally:
+            registry.stop()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_registry_concurrent_compiles():
+    import threading
+
+    from pybemhtml.compiler import Compiler
+
+    class CountingCompiler(Compiler):
+        active = 0
+        overlapped = False
+
+        def compile(self, js):
+            CountingCompiler.active += 1
+            CountingCompiler.overlapped |= CountingCompiler.active > 1
+
+            try:
+                time.sleep(0.01)
+
+                return Compiler.compile(self, js)
+            finally:
+                CountingCompiler.active -= 1
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        registry = TemplateRegistry(compiler=CountingCompiler())
+        paths = []
+
+        for n in range(8):
+            path = os.path.join(directory, 'page%d.js' % n)
+            write(path, 'function render() { return %d; }' % n, time.time())
+            paths.append(path)
+
+        threads = [threading.Thread(target=registry.add, args=('page%d' % n, path)) for n, path in enumerate(paths)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert not CountingCompiler.overlapped
+
+        for n in range(8):
+            assert registry['page%d' % n].scope['render'](undefined, []) == n
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+import time
+
+import pybemhtml
+
+RUNTIME = 'import pybemhtml.cache, pybemhtml.library, pybemhtml.loader, pybemhtml.pool'
+
+# Milliseconds a fresh worker may spend importing the runtime on top of the
+# interpreter startup, generous so that slow machines pass
+BUDGET = 250
+
+
+def run(script):
+    root = os.path.dirname(os.path.dirname(pybemhtml.__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+
+    return subprocess.check_output([sys.executable, '-c', script], env=env)
+
+
+def test_runtime_imports():
+    # Loading precompiled templates must not import the parser or JSON
+    script = (
+        "import sys\n"
+        "%s\n"
+        "print sorted(name for name in ('json', 'simplejson', 'pybemhtml.compiler', 'pyjsparser') if name in sys.modules)\n"
+    ) % RUNTIME
+
+    assert run(script).strip() == '[]'
+
+
+def test_runtime_import_time():
+    def best(script):
+        timings = []
+
+        for i in range(3):
+            start = time.time()
+            run(script)
+            timings.append(time.time() - start)
+
+        return min(timings)
+
+    overhead = (best(RUNTIME) - best('pass')) * 1000
+
+    assert overhead < BUDGET, 'runtime import takes %.1fms, over the %dms budget' % (overhead, BUDGET)
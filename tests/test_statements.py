@@ -1,6 +1,3 @@
-import sys
-from os import path
-
 from pybemhtml.compiler import Compiler
 
 
@@ -22,15 +19,7 @@ def test_break():
     assert(i == 2);
     """
 
-    python = Compiler().compile(source)
-
-    basedir = path.dirname(__file__)
-
-    open(path.join(basedir, 'tmp', 'statements_js.py'), 'w').write(python)
-
-    sys.path.append(path.join(basedir, 'tmp'))
-
-    import statements_js
+    Compiler().compile_to_module(source)
 
 
 def test_switch():
@@ -77,12 +66,239 @@ def test_switch():
 
     """
 
-    python = Compiler().compile(source)
+    Compiler().compile_to_module(source)
+
+
+def test_scope():
+    source = u"""
+    g = 1;
+
+    function outer(a) {
+        assert(typeof(hoisted) == 'undefined');
+
+        var counter = 0;
+
+        function inc() {
+            counter++;
+            g = g + 1;
+            return counter;
+        }
+
+        inc();
+        inc();
+
+        if (false) {
+            var hoisted = 1;
+        }
+
+        var shadow = function(a) { return a; };
+
+        assert(shadow(5) == 5);
+        assert(arguments.length == 1);
+
+        return counter + a;
+    }
+
+    assert(outer(10) == 12);
+    assert(g == 3);
+    """
+
+    Compiler().compile_to_module(source)
+
+
+def test_properties():
+    source = u"""
+    function check(ctx) {
+        assert(ctx.block == 'b1');
+        assert(typeof(ctx.missing) == 'undefined');
+        assert(ctx.hasOwnProperty('block'));
+        assert(ctx['block'] == 'b1');
+
+        ctx.elem = 'e1';
+
+        return ctx.elem;
+    }
+
+    assert(check({block: 'b1'}) == 'e1');
+    assert({block: 'b2'}.block == 'b2');
+    assert([1, 2, 3].length == 3);
+    """
+
+    Compiler().compile_to_module(source)
+
+
+def test_array_properties():
+    source = u"""
+    function tagged(name) {
+        var items = [1, 2];
+        items.name = name;
+        items[3] = 4;
+        return items;
+    }
+
+    a = tagged('a');
+    b = tagged('b');
+
+    assert(a.name == 'a');
+    assert(b.name == 'b');
+    assert(a.length == 4);
+    assert(a[1] == 2);
+
+    // Not an index, though isdigit accepts it
+    a['\u00b2'] = 'squared';
+    assert(a['\u00b2'] == 'squared');
+    assert(a.length == 4);
+
+    function callee() {
+        return arguments.callee;
+    }
+
+    assert(callee() === callee);
+    """
+
+    Compiler().compile_to_module(source)
+
+
+def test_loops():
+    source = u"""
+    function find(items, wanted) {
+        var i = 0;
+        var found = -1;
+
+        outer: while (i < items.length) {
+            var row = items[i];
+            var j = 0;
+            i++;
+
+            while (j < row.length) {
+                j++;
+
+                if (row[j - 1] == 'skip') {
+                    continue outer;
+                }
+
+                switch (row[j - 1]) {
+                    case 'stop':
+                        break outer;
+                    case 'next':
+                        continue;
+                }
+
+                if (row[j - 1] == wanted) {
+                    found = i - 1;
+                    break outer;
+                }
+            }
+        }
+
+        return found;
+    }
+
+    assert(find([['a', 'b'], ['skip', 'c'], ['next', 'c']], 'c') == 2);
+    assert(find([['a'], ['stop', 'c'], ['c']], 'c') == -1);
+
+    function keys(object) {
+        var result = '';
+
+        for (var key in object) {
+            block: {
+                if (key == 'b') {
+                    break block;
+                }
+
+                result = result + key;
+            }
+        }
+
+        return result;
+    }
+
+    assert(keys({a: 1, b: 2, c: 3}) == 'ac');
+    """
+
+    Compiler().compile_to_module(source)
+
+
+def test_switch_table():
+    source = u"""
+    function kind(tag) {
+        switch (tag) {
+            case 'a':
+            case 'link':
+                return 'link';
+            case 'img':
+                return 'image';
+            case 1:
+                return 'number';
+            default:
+                return 'other';
+        }
+    }
+
+    assert(kind('a') == 'link');
+    assert(kind('link') == 'link');
+    assert(kind('img') == 'image');
+    assert(kind(1) == 'number');
+    assert(kind('div') == 'other');
+    assert(kind({}) == 'other');
+
+    function count(n) {
+        var steps = 0;
+
+        switch (n) {
+            case 3:
+                steps++;
+            case 2:
+                steps++;
+            case 1:
+                steps++;
+                break;
+            case 0:
+        }
+
+        return steps;
+    }
+
+    assert(count(3) == 3);
+    assert(count(2) == 2);
+    assert(count(0) == 0);
+    assert(count(5) == 0);
+
+    function first(n) {
+        switch (n) {
+            case 1:
+                return 'first';
+            case 1.0:
+                return 'second';
+        }
+
+        return 'none';
+    }
+
+    assert(first(1) == 'first');
+    assert(first(2) == 'none');
+    """
+
+    Compiler().compile_to_module(source)
 
-    basedir = path.dirname(__file__)
 
-    open(path.join(basedir, 'tmp', 'statements_switch.py'), 'w').write(python)
+def test_switch_table_errors():
+    from pybemhtml.library import undefined
 
-    sys.path.append(path.join(basedir, 'tmp'))
+    module = Compiler().compile_to_module(u"""
+    function kind(o) {
+        switch (o.missing()) {
+            case 'a':
+                return 'a';
+            default:
+                return 'default';
+        }
+    }
+    """)
 
-    import statements_switch
+    try:
+        module.scope['kind'](undefined, [{}])
+    except TypeError:
+        pass
+    else:
+        assert False, 'discriminant errors must propagate'